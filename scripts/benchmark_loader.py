@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+# Copyright 2019-present, Mila
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Measures ClevrDataLoader throughput without any model compute, e.g.
+
+    scripts/benchmark_loader.py --data_dir $DATA/sqoop-variety_1-repeats_30000 \
+        --num_workers 0,2,4 --batch_size 64,128 --decode_modes sample,batch
+
+Every combination of the swept options runs in a fresh process and reports
+samples/sec, the time per batch of each loading stage (h5 read, PNG decode,
+collate, transfer, measured on the dataset in the main process) and the
+peak RSS of the process and of its loader workers. Results are printed as
+JSON, or written to --output.
+
+Decode modes: 'sample' decodes PNGs in __getitem__, 'batch' decodes them
+per batch on --decode_threads threads and 'cache' reads the decoded cache
+built by cache_decoded_features.py.
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+import vr.utils as utils
+from vr.data import ClevrDataLoader, _read_rows, clevr_batch_collate, decode_png_batch
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_dir', default='.')
+parser.add_argument('--split', default='train')
+parser.add_argument('--vocab_json', default='vocab.json')
+parser.add_argument('--num_workers', default='0')
+parser.add_argument('--batch_size', default='64')
+parser.add_argument('--load_features', default='0')
+parser.add_argument('--decode_modes', default='sample')
+parser.add_argument('--batch_fetch', default='0')
+parser.add_argument('--fixed_shape', default='0')
+parser.add_argument('--decode_threads', default=4, type=int)
+parser.add_argument('--num_batches', default=100, type=int)
+parser.add_argument('--num_stage_batches', default=10, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--output', default=None)
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+def _max_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_stages(loader, batch_size, device, num_batches, rng):
+    """
+    Times the loading stages of random batches one after another, reading
+    the features the same way as the dataset does for the chosen mode and
+    collating with the collate function of the loader.
+    """
+    dataset = loader.dataset
+    dataset._open_features()
+    times = {'read': 0., 'decode': 0., 'collate': 0., 'transfer': 0.}
+    for _ in range(num_batches):
+        indices = rng.choice(len(dataset), min(batch_size, len(dataset)), replace=False)
+        image_idxs = dataset.all_image_idxs[indices].numpy()
+        unique_idxs = np.unique(image_idxs)
+
+        start = time.time()
+        if dataset.decoded_cache_path is not None:
+            raw = dataset.decoded_images[unique_idxs]
+        elif dataset.load_features:
+            raw = dataset.features[unique_idxs]
+        else:
+            raw = _read_rows(dataset.feature_h5['features'], unique_idxs)
+        times['read'] += time.time() - start
+
+        start = time.time()
+        if raw.dtype == object:
+            decode_png_batch(raw, max(dataset.decode_threads, 1))
+        elif raw.dtype == np.uint8:
+            torch.from_numpy(np.asarray(raw)).float().div_(255.0)
+        else:
+            torch.from_numpy(np.asarray(raw, dtype=np.float32))
+        times['decode'] += time.time() - start
+
+        # Samples as the loader gets them, e.g. with undecoded PNGs when
+        # they are decoded per batch by the collate function
+        if loader.collate_fn is clevr_batch_collate:
+            samples = dataset[indices.tolist()]
+        else:
+            samples = [dataset[int(index)] for index in indices]
+        start = time.time()
+        batch = loader.collate_fn(samples)
+        times['collate'] += time.time() - start
+
+        start = time.time()
+        for tensor in [batch[0], batch[2], batch[3]]:
+            if torch.is_tensor(tensor):
+                if device.type == 'cuda':
+                    tensor = tensor.pin_memory()
+                tensor.to(device, non_blocking=True)
+        _synchronize(device)
+        times['transfer'] += time.time() - start
+    # Forked workers must not inherit the open h5 file
+    if dataset.feature_h5 is not None:
+        dataset.feature_h5.close()
+    dataset.feature_h5 = None
+    dataset.features = None
+    dataset.decoded_images = None
+    return {stage: value / num_batches for stage, value in times.items()}
+
+
+def run_config(args, config, results):
+    device = torch.device(args.device)
+    vocab = utils.load_vocab(os.path.join(args.data_dir, args.vocab_json))
+    loader_kwargs = {
+      'question_h5': os.path.join(args.data_dir, args.split + '_questions.h5'),
+      'feature_h5': os.path.join(args.data_dir, args.split + '_features.h5'),
+      'vocab': vocab,
+      'load_features': config['load_features'],
+      'decoded_cache': config['decode_mode'] == 'cache',
+      'decode_threads': args.decode_threads if config['decode_mode'] == 'batch' else 0,
+      'batch_fetch': config['batch_fetch'] == 1,
+      'fixed_shape': config['fixed_shape'] == 1,
+      'batch_size': config['batch_size'],
+      'shuffle': True,
+      'num_workers': config['num_workers'],
+      'pin_memory': device.type == 'cuda',
+    }
+    result = dict(config)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.time()
+            loader = ClevrDataLoader(**loader_kwargs)
+            result['setup_seconds'] = time.time() - start
+
+        result['stage_seconds_per_batch'] = time_stages(
+            loader, config['batch_size'], device, args.num_stage_batches,
+            np.random.RandomState(args.seed))
+
+        num_batches, num_samples = 0, 0
+        start = time.time()
+        batches = iter(loader)
+        while num_batches < args.num_batches:
+            try:
+                batch = next(batches)
+            except StopIteration:
+                batches = iter(loader)
+                continue
+            batch[2].to(device, non_blocking=True)
+            if num_batches == 0:
+                _synchronize(device)
+                result['first_batch_seconds'] = time.time() - start
+                start = time.time()
+            else:
+                num_samples += batch[2].size(0)
+            num_batches += 1
+        _synchronize(device)
+        elapsed = time.time() - start
+        # Shut the workers down so that their peak RSS is accounted for
+        del batches
+        loader.close()
+
+        result['samples_per_second'] = num_samples / elapsed if elapsed > 0 else None
+        result['peak_rss_mb'] = _max_rss_mb(resource.RUSAGE_SELF)
+        result['peak_worker_rss_mb'] = _max_rss_mb(resource.RUSAGE_CHILDREN)
+    except Exception as e:
+        result['error'] = repr(e)
+    results.put(result)
+
+
+def main(args):
+    configs = []
+    for (num_workers, batch_size, load_features, decode_mode, batch_fetch,
+         fixed_shape) in itertools.product(
+            _int_list(args.num_workers), _int_list(args.batch_size),
+            _int_list(args.load_features), args.decode_modes.split(','),
+            _int_list(args.batch_fetch), _int_list(args.fixed_shape)):
+        if decode_mode not in ['sample', 'batch', 'cache']:
+            raise ValueError('Invalid decode mode "%s"' % decode_mode)
+        configs.append({'num_workers': num_workers,
+                        'batch_size': batch_size,
+                        'load_features': load_features,
+                        'decode_mode': decode_mode,
+                        'batch_fetch': batch_fetch,
+                        'fixed_shape': fixed_shape})
+
+    # Every configuration runs in its own process, so that the peak RSS of
+    # one is not carried over to the next
+    context = multiprocessing.get_context('spawn')
+    all_results = []
+    for config in configs:
+        results = context.Queue()
+        process = context.Process(target=run_config, args=(args, config, results))
+        process.start()
+        result = results.get()
+        process.join()
+        print('%s: %s samples/sec' % (config, result.get('samples_per_second', result.get('error'))),
+              file=sys.stderr)
+        all_results.append(result)
+
+    output = json.dumps({'data_dir': args.data_dir,
+                         'split': args.split,
+                         'device': args.device,
+                         'num_batches': args.num_batches,
+                         'results': all_results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+# Copyright 2019-present, Mila
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Decodes the PNG images of one or more *_features.h5 files into contiguous
+uint8 .npy files that ClevrDataset memory-maps when run with decoded_cache=True.
+"""
+
+import argparse
+
+from vr.data import build_decoded_cache, decoded_cache_is_current, decoded_cache_path
+
+parser = argparse.ArgumentParser()
+parser.add_argument('features_h5', nargs='+')
+parser.add_argument('--overwrite', action='store_true')
+
+
+def main(args):
+    for feature_h5_path in args.features_h5:
+        cache_path = decoded_cache_path(feature_h5_path)
+        if decoded_cache_is_current(feature_h5_path, cache_path) and not args.overwrite:
+            print('Cache already exists ', cache_path)
+            continue
+        print('Decoding ', feature_h5_path)
+        build_decoded_cache(feature_h5_path, cache_path, overwrite=args.overwrite)
+        print('Wrote ', cache_path)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# Copyright 2019-present, Mila
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Converts *_questions.h5 / *_features.h5 pairs into the sharded format read by
+ShardedClevrDataLoader, e.g.
+
+    scripts/convert_to_shards.py --data_dir $DATA/sqoop-variety_1-repeats_30000 \
+        --splits train --output_dir $SHARDS
+"""
+
+import argparse
+import os
+
+from vr.data import write_shards
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_dir', default='.')
+parser.add_argument('--output_dir', default=None)
+parser.add_argument('--splits', default='train,val,test')
+parser.add_argument('--shard_size', default=10000, type=int)
+
+
+def main(args):
+    output_dir = args.output_dir or args.data_dir
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for split in args.splits.split(','):
+        question_h5 = os.path.join(args.data_dir, split + '_questions.h5')
+        feature_h5 = os.path.join(args.data_dir, split + '_features.h5')
+        print('Converting ', question_h5, feature_h5)
+        paths = write_shards(question_h5, feature_h5,
+                             os.path.join(output_dir, split),
+                             shard_size=args.shard_size)
+        print('Wrote %d shards' % len(paths))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -4,6 +4,7 @@ import io
 import json
 import logging
 import math
+import multiprocessing
 import string
 import time
 import random
@@ -44,10 +45,29 @@ def unary_relation_module(relation):
 
 
 
+class GlyphAtlas(object):
+    """
+    The image of every shape at every font size, rendered once so that
+    drawing a scene only composites them. Objects are not rotated when drawn,
+    so the images do not depend on the angle.
+    """
+    def __init__(self, fonts, shapes):
+        self.sizes = {}
+        self.glyphs = {}
+        for fontsize, font in fonts.items():
+            width, size = font.getsize('A')
+            self.sizes[fontsize] = size
+            for shape in shapes:
+                img = Image.new('RGBA', (size, size))
+                draw = ImageDraw.Draw(img)
+                draw.text((0,0), shape, font=font, fill='green')
+                self.glyphs[shape, fontsize] = img
+
+
 class Object(object):
     def __init__(self, fontsize, angle=0, pos=None, shape=None):
-        self.font = FONT_OBJECTS[fontsize]
-        width, self.size = self.font.getsize('A')
+        self.fontsize = fontsize
+        self.size = GLYPHS.sizes[fontsize]
         self.angle = angle
         angle_rad = angle / 180 * math.pi
         self.rotated_size =  math.ceil(self.size * (abs(math.sin(angle_rad)) + abs(math.cos(angle_rad))))
@@ -71,9 +91,8 @@ class Object(object):
         raise ValueError(rel)
 
     def draw(self):
-        img = Image.new('RGBA', (self.size, self.size))
-        draw = ImageDraw.Draw(img)
-        draw.text((0,0), self.shape, font=self.font, fill='green')
+        # Shared with the other objects, must not be modified
+        img = GLYPHS.glyphs[self.shape, self.fontsize]
 
         #if self.angle != 0:
         #  img = img.rotate(self.angle, expand=True, resample=Image.LINEAR)
@@ -146,6 +165,10 @@ def get_random_spot(rng, objects, rel = None,  rel_holds = False, rel_obj = 0):
         max_center_x = max_center_y = max_center
 
 
+    if args.placement == 'vectorized':
+        return _place_vectorized(rng, obj, objects, min_center_x, max_center_x,
+                                 min_center_y, max_center_y)
+
     for attempt in range(10):
         x = rng.randint(min_center_x, max_center_x)
         y = rng.randint(min_center_y, max_center_y)
@@ -162,6 +185,36 @@ def get_random_spot(rng, objects, rel = None,  rel_holds = False, rel_obj = 0):
         return None
 
 
+def _place_vectorized(rng, obj, objects, min_center_x, max_center_x,
+                      min_center_y, max_center_y, num_attempts=10):
+    """
+    Places `obj` like the attempts of get_random_spot, but tests all of them
+    at once. The candidate centres are always drawn as one block of
+    `num_attempts` (x, y) pairs of uniform samples scaled to the bounds,
+    whichever of them is picked, so every call consumes the same amount of
+    randomness.
+    """
+    low = numpy.array([min_center_x, min_center_y])
+    candidates = low + (rng.random_sample((num_attempts, 2))
+                        * [max_center_x - min_center_x, max_center_y - min_center_y]).astype(int)
+    if objects:
+        other_pos = numpy.array([other.pos for other in objects])
+        min_dist = (obj.rotated_size + numpy.array([other.rotated_size for other in objects])) // 2 + 1
+        # attempts x objects x 2
+        dist = numpy.abs(candidates[:, None, :] - other_pos)
+        # no coordinate closer than 5 to another object's and no overlap
+        # between bounding squares
+        valid = ((dist.min(axis=2) >= 5) & (dist.max(axis=2) >= min_dist)).all(axis=1)
+        first = valid.argmax()
+        if not valid[first]:
+            return None
+    else:
+        first = 0
+    x, y = candidates[first]
+    obj.pos = (int(x), int(y))
+    return obj
+
+
 def generate_scene(rng, sampler, objects=[], restrict = False, **kwargs):
     orig_objects = objects
 
@@ -195,9 +248,14 @@ def generate_scene(rng, sampler, objects=[], restrict = False, **kwargs):
 class Sampler:
     def __init__(self, test, seed, objects):
         self._test = test
+        self._seed = seed
         self._rng = numpy.random.RandomState(seed)
         self.objects = objects
 
+    def reseed(self, *keys):
+        """Restarts sampling from a seed derived from the original seed and `keys`."""
+        self._rng = numpy.random.RandomState([self._seed] + list(keys))
+
     def _choose(self, list_like):
         return list_like[self._rng.randint(len(list_like))]
 
@@ -241,7 +299,108 @@ def LongTailSampler(long_tail_dist):
     return partial(_LongTailSampler, long_tail_dist)
 
 
-def gen_data(obj_pairs, sampler, seed, vocab, prefix, question_vocab, program_vocab):
+def load_fonts(font):
+    return { font_size : ImageFont.truetype(font) for font_size in range(10, 16) }
+
+
+def encode_image(image):
+    """
+    Returns a scene image the way it is stored, PNG-compressed into a flat
+    uint8 array or as a raw 3 x H x W uint8 array.
+    """
+    if args.image_format == 'raw':
+        return numpy.asarray(image).transpose(2, 0, 1)
+    buffer_ = io.BytesIO()
+    image.save(buffer_, format='png')
+    return numpy.frombuffer(buffer_.getvalue(), dtype='uint8')
+
+
+def generate_examples(obj_pairs, sampler, rng, vocab, relations, rejection_sampling, start=0):
+    """
+    Generates the examples for `obj_pairs`, which start at index `start` of
+    their split, and yields (scene, image, question, program, answer) for
+    each, with the image encoded by encode_image. Rejected attempts are
+    counted in `rejection_sampling`.
+    """
+    i = 0
+    while i < len(obj_pairs):
+        label = ((start + i) % 2) == 0
+        scene, question, program, success, key = generate_image_and_question(
+            obj_pairs[i], sampler, rng, label, vocab, relations[i])
+        rejection_sampling[key] += 1
+        if success:
+            image = encode_image(draw_scene(scene))
+            yield scene, image, question, program, int(label)
+            i += 1
+
+
+def _init_worker(worker_args):
+    global args, GLYPHS
+    args = worker_args
+    GLYPHS = GlyphAtlas(load_fonts(args.font), SHAPES)
+
+
+def _generate_shard(task):
+    """
+    Generates one shard of a split in a worker process. The shard is seeded
+    from the split seed and its id only, so that the output does not depend
+    on the number of workers.
+    """
+    shard_id, start, obj_pairs, relations, sampler, seed, vocab, question_vocab, program_vocab = task
+    rng = numpy.random.RandomState([seed, shard_id])
+    sampler.reseed(shard_id)
+    rejection_sampling = collections.Counter()
+    features, questions, programs, answers, scenes = [], [], [], [], []
+    for scene, image, question, program, answer in generate_examples(
+            obj_pairs, sampler, rng, vocab, relations, rejection_sampling, start):
+        features.append(image)
+        questions.append([question_vocab[w] for w in question])
+        programs.append([program_vocab[w] for w in program])
+        answers.append(answer)
+        # Scenes are sent back in the form they are dumped in
+        scenes.append([CustomJSONEncoder().default(obj) for obj in scene])
+    return start, features, questions, programs, answers, scenes, rejection_sampling
+
+
+class ExampleWriter(object):
+    """
+    Buffers the rows of a split in NumPy arrays and writes them to the h5
+    datasets in blocks of `block_size` rows, rounded up to a multiple of the
+    chunk sizes so that every chunk is written at once.
+    """
+    def __init__(self, datasets, block_size=2048):
+        self.datasets = datasets
+        for dataset in datasets.values():
+            if dataset.chunks is not None:
+                rows = dataset.chunks[0]
+                block_size = -(-block_size // rows) * rows
+        self.block_size = block_size
+        self.buffers = {name: numpy.empty((block_size,) + dataset.shape[1:], dtype=dataset.dtype)
+                        for name, dataset in datasets.items()}
+        self.start = 0
+        self.num_buffered = 0
+
+    def write(self, **row):
+        for name, value in row.items():
+            self.buffers[name][self.num_buffered] = value
+        self.num_buffered += 1
+        if self.num_buffered == self.block_size:
+            self.flush()
+
+    def flush(self):
+        end = self.start + self.num_buffered
+        for name, dataset in self.datasets.items():
+            dataset[self.start:end] = self.buffers[name][:self.num_buffered]
+        self.start = end
+        self.num_buffered = 0
+
+
+def print_progress(num_done, num_examples, rejection_sampling):
+    print("\r>> Done with %d/%d examples : %s " %(num_done, num_examples,  rejection_sampling), end = '')
+    sys.stdout.flush()
+
+
+def gen_data(obj_pairs, sampler, seed, vocab, prefix, question_vocab, program_vocab, pool=None):
     num_examples = len(obj_pairs)
 
     max_question_len = 3
@@ -254,42 +413,73 @@ def gen_data(obj_pairs, sampler, seed, vocab, prefix, question_vocab, program_vo
 
     presampled_relations = [sampler.sample_relation() for ex in obj_pairs] # pre-sample relations
     with h5py.File(prefix + '_questions.h5', 'w') as dst_questions, h5py.File(prefix + '_features.h5', 'w') as dst_features:
-        features_dtype = h5py.special_dtype(vlen=numpy.dtype('uint8'))
-        features_dataset = dst_features.create_dataset('features', (num_examples,), dtype=features_dtype)
+        if args.image_format == 'raw':
+            image_shape = (3, args.image_size, args.image_size)
+            features_dataset = dst_features.create_dataset(
+                'features', (num_examples,) + image_shape, dtype=numpy.uint8,
+                chunks=(max(min(8, num_examples), 1),) + image_shape,
+                compression=None if args.compression == 'none' else args.compression)
+        else:
+            features_dtype = h5py.special_dtype(vlen=numpy.dtype('uint8'))
+            features_dataset = dst_features.create_dataset('features', (num_examples,), dtype=features_dtype)
         questions_dataset = dst_questions.create_dataset('questions', (num_examples, max_question_len), dtype=numpy.int64)
         programs_dataset = dst_questions.create_dataset('programs', (num_examples, max_program_len), dtype=numpy.int64)
         answers_dataset = dst_questions.create_dataset('answers', (num_examples,), dtype=numpy.int64)
         image_idxs_dataset = dst_questions.create_dataset('image_idxs', (num_examples,), dtype=numpy.int64)
 
-        i = 0
+        writer = ExampleWriter({'features': features_dataset,
+                                'questions': questions_dataset,
+                                'programs': programs_dataset,
+                                'answers': answers_dataset,
+                                'image_idxs': image_idxs_dataset})
+
         rejection_sampling = {'a' : 0, 'b' : 0, 'c' : 0, 'd' : 0, 'e' : 0, 'f' : 0}
 
-        # different seeds for train/dev/test
-        rng = numpy.random.RandomState(seed)
-        before = time.time()
+        before = last_progress = time.time()
         scenes = []
-        while i < len(obj_pairs):
-            scene, question, program, success, key = generate_image_and_question(
-                obj_pairs[i], sampler, rng, (i % 2) == 0, vocab, presampled_relations[i])
-            rejection_sampling[key] += 1
-            if success:
+        if pool is None:
+            # different seeds for train/dev/test
+            rng = numpy.random.RandomState(seed)
+            examples = generate_examples(obj_pairs, sampler, rng, vocab,
+                                         presampled_relations, rejection_sampling)
+            for i, (scene, image, question, program, answer) in enumerate(examples):
                 scenes.append(scene)
-                buffer_ = io.BytesIO()
-                image = draw_scene(scene)
-                image.save(buffer_, format='png')
-                buffer_.seek(0)
-                features_dataset[i]   = numpy.frombuffer(buffer_.read(), dtype='uint8')
-                questions_dataset[i]  = [question_vocab[w] for w in question]
-                programs_dataset[i]   = [program_vocab[w] for w in program]
-                answers_dataset[i]    = int( (i%2) == 0)
-                image_idxs_dataset[i] = i
-
-                i += 1
-                if i % 1000 == 0:
-                    time_data = "{} seconds per example".format((time.time() - before) / i )
+                writer.write(features=image,
+                             questions=[question_vocab[w] for w in question],
+                             programs=[program_vocab[w] for w in program],
+                             answers=answer,
+                             image_idxs=i)
+
+                if (i + 1) % 1000 == 0:
+                    time_data = "{} seconds per example".format((time.time() - before) / (i + 1) )
                     print(time_data)
-                print("\r>> Done with %d/%d examples : %s " %(i+1, len(obj_pairs),  rejection_sampling), end = '')
-                sys.stdout.flush()
+                if time.time() - last_progress >= 1.0:
+                    print_progress(i + 1, num_examples, rejection_sampling)
+                    last_progress = time.time()
+        else:
+            # Shards are written in order as they complete, so that the files
+            # are the same whatever the number of workers
+            tasks = [(shard_id, start, obj_pairs[start:start + args.shard_size],
+                      presampled_relations[start:start + args.shard_size],
+                      sampler, seed, vocab, question_vocab, program_vocab)
+                     for shard_id, start in enumerate(range(0, num_examples, args.shard_size))]
+            for start, features, questions, programs, answers, shard_scenes, shard_rejections in \
+                    pool.imap(_generate_shard, tasks):
+                for i in range(len(features)):
+                    writer.write(features=features[i],
+                                 questions=questions[i],
+                                 programs=programs[i],
+                                 answers=answers[i],
+                                 image_idxs=start + i)
+                scenes.extend(shard_scenes)
+                for key, count in shard_rejections.items():
+                    rejection_sampling[key] += count
+
+                if time.time() - last_progress >= 1.0:
+                    print_progress(start + len(features), num_examples, rejection_sampling)
+                    last_progress = time.time()
+        writer.flush()
+        print_progress(num_examples, num_examples, rejection_sampling)
 
     print("{} seconds per example".format((time.time() - before) / len(obj_pairs) ))
 
@@ -460,9 +650,17 @@ def gen_sqoop(vocab):
             dst, indent=2)
 
 
-    gen_data(train_pairs, train_sampler, 1, vocab, 'train', question_vocab, program_vocab)
-    gen_data(val_pairs, val_sampler, 2, vocab, 'val', question_vocab, program_vocab)
-    gen_data(test_pairs, test_sampler, 3, vocab, 'test', question_vocab, program_vocab)
+    pool = None
+    if args.num_workers > 0:
+        pool = multiprocessing.Pool(args.num_workers, initializer=_init_worker, initargs=(args,))
+    try:
+        gen_data(train_pairs, train_sampler, 1, vocab, 'train', question_vocab, program_vocab, pool)
+        gen_data(val_pairs, val_sampler, 2, vocab, 'val', question_vocab, program_vocab, pool)
+        gen_data(test_pairs, test_sampler, 3, vocab, 'test', question_vocab, program_vocab, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 def gen_image_understanding_test():
@@ -519,6 +717,21 @@ if __name__ == '__main__':
     parser.add_argument('--max-obj-size', type=int, default=15)
     parser.add_argument('--no-rotate', action='store_false', dest='rotate')
     parser.add_argument('--font', default='arial.ttf')
+    parser.add_argument('--image-format', choices=('png', 'raw'), default='png',
+                        help='raw stores the images as an N x 3 x H x W uint8 dataset, '
+                             'which is larger but needs no decoding')
+    parser.add_argument('--compression', choices=('none', 'lzf', 'gzip'), default='none',
+                        help='h5 compression of the images with --image-format raw, '
+                             'which makes the files smaller but slower to read')
+    parser.add_argument('--placement', choices=('sequential', 'vectorized'), default='sequential',
+                        help='vectorized tests all the candidate spots of an object at once, '
+                             'it draws different scenes than sequential for the same seed')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='generate the examples in shards on this many processes, '
+                             '0 to generate them serially')
+    parser.add_argument('--shard-size', type=int, default=1000,
+                        help='number of examples per shard with --num-workers, '
+                             'the output depends on it but not on the number of workers')
     args = parser.parse_args()
 
     args.level = 'relations'
@@ -532,7 +745,7 @@ if __name__ == '__main__':
     with open('args.txt', 'w') as dst:
         print(args, file=dst)
 
-    FONT_OBJECTS = { font_size : ImageFont.truetype(args.font) for font_size in range(10, 16) }
+    GLYPHS = GlyphAtlas(load_fonts(args.font), SHAPES)
 
     vocab = SHAPES[:args.num_shapes]
     if args.mode == 'sqoop':
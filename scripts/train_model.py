@@ -8,6 +8,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import getpass
 import json
 import os
 import pdb
@@ -30,8 +31,13 @@ import torch.nn.functional as F
 import vr
 import vr.utils
 import vr.preprocess
+from vr.cache import LocalFileCache
 from vr.data import (ClevrDataset,
-                     ClevrDataLoader)
+                     ClevrDataLoader,
+                     ShardedClevrDataLoader,
+                     ShardedClevrDataset,
+                     PrefetchLoader,
+                     normalize_images)
 from vr.models import *
 from vr.treeGenerator import TreeGenerator
 
@@ -63,9 +69,13 @@ def one_or_list(parser):
 parser.add_argument('--data_dir', default='data')
 parser.add_argument('--train_question_h5', default='train_questions.h5')
 parser.add_argument('--train_features_h5', default='train_features.h5')
+parser.add_argument('--train_extra_data_dirs', default=None)  # comma-separated, trained on with data_dir
+parser.add_argument('--train_source_weights', default=None)  # comma-separated, data_dir first
 parser.add_argument('--val_question_h5', default='val_questions.h5')
 parser.add_argument('--val_features_h5', default='val_features.h5')
 
+parser.add_argument('--train_shards', default=None)  # glob of shards, replaces train_*_h5
+parser.add_argument('--shuffle_buffer', default=10000, type=int)
 parser.add_argument('--valB_question_h5', default=None)
 parser.add_argument('--valB_features_h5', default=None)
 
@@ -73,16 +83,34 @@ parser.add_argument('--feature_dim', default=[1024,14,14], type=parse_int_list)
 parser.add_argument('--vocab_json', default='vocab.json')
 
 parser.add_argument('--load_features', type=int, default=1)
+parser.add_argument('--decoded_cache', type=int, default=0)  # memmap decoded PNG features
 parser.add_argument('--loader_num_workers', type=int, default=0)
-parser.add_argument('--use_local_copies', default=0, type=int)
-parser.add_argument('--cleanup_local_copies', default=1, type=int)
+parser.add_argument('--loader_persistent_workers', type=int, default=0)  # keep workers across passes
+parser.add_argument('--loader_batch_fetch', type=int, default=0)  # fetch whole batches from h5
+parser.add_argument('--loader_decode_threads', type=int, default=0)  # decode PNGs per batch in threads
+parser.add_argument('--loader_fixed_shape_collate', type=int, default=0)  # reuse preallocated batches
+parser.add_argument('--loader_device_resident', type=int, default=0)  # keep whole splits on device
+parser.add_argument('--prefetch_batches', type=int, default=0)  # batches moved to device ahead of time
+parser.add_argument('--loader_block_shuffle', type=int, default=0)  # shuffle h5 chunk-aligned blocks, fetches whole batches
+parser.add_argument('--loader_shuffle_block_size', type=int, default=None)  # h5 chunk size, or batch size if unchunked
+parser.add_argument('--loader_shuffle_window_blocks', type=int, default=16)  # blocks mixed together
+parser.add_argument('--loader_bucket_by_length', type=int, default=0)  # batch questions of similar length
+parser.add_argument('--loader_bucket_batches', type=int, default=100)  # batches per length-sorted window
+parser.add_argument('--loader_trim_questions', type=int, default=0)  # drop padding columns per batch
+parser.add_argument('--loader_uint8_images', type=int, default=0)  # normalize images on the device
+parser.add_argument('--loader_pair_sampling', default=None, choices=['stratified', 'balanced'])
+parser.add_argument('--train_pairs_file', default=None)  # JSON list of [lhs, rel, rhs], null matches any
+parser.add_argument('--use_local_copies', default=0, type=int)  # 1: MILA /Tmp, 2: $SLURM_TMPDIR
+parser.add_argument('--local_cache_dir', default=None)  # copy the data to this node-local cache
+parser.add_argument('--local_cache_size_gb', default=None, type=float)  # evict LRU files above this
 
 parser.add_argument('--family_split_file', default=None)
-parser.add_argument('--num_train_samples', default=None, type=int)
+parser.add_argument('--num_train_samples', default=None, type=int)  # in total, data_dir first with train_extra_data_dirs
 parser.add_argument('--num_val_samples', default=None, type=int)
 parser.add_argument('--shuffle_train_data', default=1, type=int)
+parser.add_argument('--loader_seed', default=None, type=int)  # random if not given, kept on resume
 
-parser.add_argument('--percent_of_data_for_training', default=1., type=float)
+parser.add_argument('--percent_of_data_for_training', default=1., type=float)  # of every train_extra_data_dirs too
 parser.add_argument('--simple_encoder', default=0, type=int)
 
 # What type of model to use and which parts to train
@@ -276,6 +304,8 @@ def main(args):
         args.train_features_h5 = os.path.join(args.data_dir, args.train_features_h5)
         args.val_question_h5 = os.path.join(args.data_dir, args.val_question_h5)
         args.val_features_h5 = os.path.join(args.data_dir, args.val_features_h5)
+        if args.train_shards:
+            args.train_shards = os.path.join(args.data_dir, args.train_shards)
 
         if args.valB_question_h5 and args.valB_features_h5:
             args.valB_question_h5 = os.path.join(args.data_dir, args.valB_question_h5)
@@ -283,6 +313,17 @@ def main(args):
 
         args.vocab_json = os.path.join(args.data_dir, args.vocab_json)
 
+    if args.train_extra_data_dirs:
+        # The training files of every directory are read as one dataset
+        extra_dirs = args.train_extra_data_dirs.split(',')
+        args.train_question_h5 = [args.train_question_h5] + [
+            os.path.join(d, os.path.basename(args.train_question_h5)) for d in extra_dirs]
+        args.train_features_h5 = [args.train_features_h5] + [
+            os.path.join(d, os.path.basename(args.train_features_h5)) for d in extra_dirs]
+    train_source_weights = None
+    if args.train_source_weights:
+        train_source_weights = [float(w) for w in args.train_source_weights.split(',')]
+
     if not args.checkpoint_path:
         if 'SLURM_JOB_ID' in os.environ:
             args.checkpoint_path = os.environ['SLURM_JOB_ID'] + '.pt'
@@ -292,82 +333,126 @@ def main(args):
         args.vocab_json = os.path.join(args.data_dir, args.vocab_json)
     vocab = vr.utils.load_vocab(args.vocab_json)
 
-    def rsync(src, dst):
-        os.system("rsync -vrz --progress {} {}".format(src, dst))
-
-    def rsync_copy_if_not_exists(src, dst):
-        if not os.path.exists(dst):
-            rsync(src, dst)
-
-    if args.use_local_copies == 1:
-        # version for MILA, copy only if doesn't exist
-        if os.path.exists('/Tmpfast'):
-            tmp = '/Tmpfast/'
-        else:
-            tmp = '/Tmp/'
-        if not os.path.exists(tmp + 'bahdanau'):
-            os.mkdir(tmp + 'bahdanau')
-        if not os.path.exists(tmp + 'bahdanau/clevr'):
-            os.mkdir(tmp + 'bahdanau/clevr')
-        root = tmp + 'bahdanau/clevr/'
-
-        rsync_copy_if_not_exists(args.train_question_h5, root + 'train_questions.h5')
-        rsync_copy_if_not_exists(args.train_features_h5, root + 'train_features.h5')
-        rsync_copy_if_not_exists(args.val_question_h5, root + 'val_questions.h5')
-        rsync_copy_if_not_exists(args.val_features_h5, root + 'val_features.h5')
-        args.train_question_h5 = root + 'train_questions.h5'
-        args.train_features_h5 = root + 'train_features.h5'
-        args.val_question_h5 = root + 'val_questions.h5'
-        args.val_features_h5 = root + 'val_features.h5'
-
-        if args.valB_question_h5 and args.valB_features_h5:
-            rsync_copy_if_not_exists(args.valB_question_h5, root + 'valB_questions.h5')
-            rsync_copy_if_not_exists(args.valB_features_h5, root + 'valB_features.h5')
-            args.valB_question_h5 = root + 'valB_questions.h5'
-            args.valB_features_h5 = root + 'valB_features.h5'
-
-    if args.use_local_copies == 2:
-        tmp = os.environ['SLURM_TMPDIR']
-        jobid = os.environ['SLURM_JOB_ID']
-        root = os.path.join(tmp, str(jobid))
-        os.mkdir(root)
-
-        rsync(args.train_question_h5, root + 'train_questions.h5')
-        rsync(args.train_features_h5, root + 'train_features.h5')
-        rsync(args.val_question_h5, root + 'val_questions.h5')
-        rsync(args.val_features_h5, root + 'val_features.h5')
-        args.train_question_h5 = root + 'train_questions.h5'
-        args.train_features_h5 = root + 'train_features.h5'
-        args.val_question_h5 = root + 'val_questions.h5'
-        args.val_features_h5 = root + 'val_features.h5'
+    # Dataset files are copied to a cache on the node's local disk, shared
+    # by the jobs running there, see vr.cache.LocalFileCache
+    local_cache_dir = args.local_cache_dir
+    if args.use_local_copies == 1 and local_cache_dir is None:
+        # version for MILA
+        tmp = '/Tmpfast/' if os.path.exists('/Tmpfast') else '/Tmp/'
+        local_cache_dir = os.path.join(tmp, getpass.getuser(), 'clevr_cache')
+    if args.use_local_copies == 2 and local_cache_dir is None:
+        local_cache_dir = os.path.join(os.environ['SLURM_TMPDIR'], 'clevr_cache')
+    local_cache = None
+    if local_cache_dir is not None:
+        max_size = None
+        if args.local_cache_size_gb is not None:
+            max_size = int(args.local_cache_size_gb * 2 ** 30)
+        local_cache = LocalFileCache(local_cache_dir, max_size)
+        for name in ['train_question_h5', 'train_features_h5',
+                     'val_question_h5', 'val_features_h5',
+                     'valB_question_h5', 'valB_features_h5']:
+            path = getattr(args, name)
+            if isinstance(path, list):
+                setattr(args, name, [local_cache.get(p) for p in path])
+            elif path:
+                setattr(args, name, local_cache.get(path))
 
     logger.info(args)
     question_families = None
     if args.family_split_file is not None:
         with open(args.family_split_file, 'r') as f:
             question_families = json.load(f)
+    train_pairs = None
+    if args.train_pairs_file is not None:
+        with open(args.train_pairs_file, 'r') as f:
+            train_pairs = json.load(f)
 
     train_loader_kwargs = {
       'question_h5': args.train_question_h5,
       'feature_h5': args.train_features_h5,
       'load_features': args.load_features,
+      'decoded_cache': args.decoded_cache == 1,
+      'batch_fetch': args.loader_batch_fetch == 1,
+      'decode_threads': args.loader_decode_threads,
+      'fixed_shape': args.loader_fixed_shape_collate == 1,
+      'device': device if args.loader_device_resident == 1 else None,
+      'pin_memory': device.type == 'cuda' and args.prefetch_batches > 0,
+      'block_shuffle': args.loader_block_shuffle == 1,
+      'shuffle_block_size': args.loader_shuffle_block_size,
+      'shuffle_window_blocks': args.loader_shuffle_window_blocks,
+      'bucket_by_length': args.loader_bucket_by_length == 1,
+      'bucket_batches': args.loader_bucket_batches,
+      'trim_questions': args.loader_trim_questions == 1,
+      'uint8_images': args.loader_uint8_images == 1,
+      'pair_sampling': args.loader_pair_sampling,
+      'pairs': train_pairs,
       'vocab': vocab,
       'batch_size': args.batch_size,
       'shuffle': args.shuffle_train_data == 1,
+      'resumable': True,
+      'seed': args.loader_seed,
       'question_families': question_families,
       'max_samples': args.num_train_samples,
       'num_workers': args.loader_num_workers,
+      'persistent_workers': args.loader_persistent_workers == 1,
       'percent_of_data': args.percent_of_data_for_training,
+      'source_weights': train_source_weights,
     }
+    train_loader_class = ClevrDataLoader
+    if args.train_shards:
+        # Shards are written from one split as a whole, see write_shards
+        ignored = [name for name, value in [
+            ('--num_train_samples', args.num_train_samples is not None),
+            ('--percent_of_data_for_training', args.percent_of_data_for_training < 1.0),
+            ('--family_split_file', args.family_split_file is not None),
+            ('--train_extra_data_dirs', bool(args.train_extra_data_dirs)),
+            ('--train_source_weights', bool(args.train_source_weights)),
+            ('--loader_pair_sampling', args.loader_pair_sampling is not None),
+            ('--train_pairs_file', args.train_pairs_file is not None),
+            ('--loader_bucket_by_length', args.loader_bucket_by_length == 1),
+            ('--loader_block_shuffle', args.loader_block_shuffle == 1)] if value]
+        if ignored:
+            raise ValueError('%s can not be used with --train_shards' % ', '.join(ignored))
+        train_loader_class = ShardedClevrDataLoader
+        train_loader_kwargs = {
+          'shards': args.train_shards,
+          'decode_threads': args.loader_decode_threads,
+          'uint8_images': args.loader_uint8_images == 1,
+          'pin_memory': device.type == 'cuda' and args.prefetch_batches > 0,
+          'batch_size': args.batch_size,
+          'shuffle': args.shuffle_train_data == 1,
+          'shuffle_buffer': args.shuffle_buffer,
+          'seed': args.loader_seed,
+          'num_workers': args.loader_num_workers,
+        }
+    # A loader with persistent workers resets its single iterator on every
+    # pass, so checking the training accuracy in the middle of an epoch gets
+    # a second loader over the same dataset
+    train_eval_loader_kwargs = None
+    if (train_loader_class is ClevrDataLoader and args.loader_persistent_workers == 1
+            and args.loader_num_workers > 0 and args.loader_device_resident == 0):
+        train_eval_loader_kwargs = dict(train_loader_kwargs, resumable=False,
+                                        block_shuffle=False, bucket_by_length=False,
+                                        pair_sampling=None, pairs=None,
+                                        source_weights=None)
     val_loader_kwargs = {
       'question_h5': args.val_question_h5,
       'feature_h5': args.val_features_h5,
       'load_features': args.load_features,
+      'decoded_cache': args.decoded_cache == 1,
+      'batch_fetch': args.loader_batch_fetch == 1,
+      'decode_threads': args.loader_decode_threads,
+      'fixed_shape': args.loader_fixed_shape_collate == 1,
+      'device': device if args.loader_device_resident == 1 else None,
+      'pin_memory': device.type == 'cuda' and args.prefetch_batches > 0,
+      'trim_questions': args.loader_trim_questions == 1,
+      'uint8_images': args.loader_uint8_images == 1,
       'vocab': vocab,
       'batch_size': args.batch_size,
       'question_families': question_families,
       'max_samples': args.num_val_samples,
       'num_workers': args.loader_num_workers,
+      'persistent_workers': args.loader_persistent_workers == 1,
     }
 
     if args.valB_question_h5 and args.valB_features_h5:
@@ -375,32 +460,50 @@ def main(args):
             'question_h5': args.valB_question_h5,
           'feature_h5': args.valB_features_h5,
           'load_features': args.load_features,
+          'decoded_cache': args.decoded_cache == 1,
+          'batch_fetch': args.loader_batch_fetch == 1,
+          'decode_threads': args.loader_decode_threads,
+          'fixed_shape': args.loader_fixed_shape_collate == 1,
+              'device': device if args.loader_device_resident == 1 else None,
+          'pin_memory': device.type == 'cuda' and args.prefetch_batches > 0,
+          'trim_questions': args.loader_trim_questions == 1,
+          'uint8_images': args.loader_uint8_images == 1,
           'vocab': vocab,
           'batch_size': args.batch_size,
           'question_families': question_families,
           'max_samples': args.num_val_samples,
           'num_workers': args.loader_num_workers,
+          'persistent_workers': args.loader_persistent_workers == 1,
         }
 
     if args.valB_question_h5 and args.valB_features_h5:
-        with ClevrDataLoader(**train_loader_kwargs) as train_loader, \
+        with train_loader_class(**train_loader_kwargs) as train_loader, \
              ClevrDataLoader(**val_loader_kwargs) as val_loader, \
              ClevrDataLoader(**valB_loader_kwargs) as valB_loader:
-            train_loop(args, train_loader, val_loader, valB_loader)
+            train_loop(args, train_loader, val_loader, valB_loader,
+                       train_eval_loader_kwargs=train_eval_loader_kwargs)
     else:
-        with ClevrDataLoader(**train_loader_kwargs) as train_loader, \
+        with train_loader_class(**train_loader_kwargs) as train_loader, \
              ClevrDataLoader(**val_loader_kwargs) as val_loader:
-            train_loop(args, train_loader, val_loader)
+            train_loop(args, train_loader, val_loader,
+                       train_eval_loader_kwargs=train_eval_loader_kwargs)
 
-    if args.use_local_copies == 1 and args.cleanup_local_copies == 1:
-        os.remove('/tmp/train_questions.h5')
-        os.remove('/tmp/train_features.h5')
-        os.remove('/tmp/val_questions.h5')
-        os.remove('/tmp/val_features.h5')
+    if local_cache is not None:
+        local_cache.close()
 
 
-def train_loop(args, train_loader, val_loader, valB_loader=None):
+def train_loop(args, train_loader, val_loader, valB_loader=None, train_eval_loader_kwargs=None):
     vocab = vr.utils.load_vocab(args.vocab_json)
+    train_eval_loader = train_loader
+    if train_eval_loader_kwargs is not None:
+        train_eval_loader = ClevrDataLoader(dataset=train_loader.dataset,
+                                            **train_eval_loader_kwargs)
+    if args.prefetch_batches > 0 and args.loader_device_resident == 0:
+        train_loader = PrefetchLoader(train_loader, device, args.prefetch_batches)
+        train_eval_loader = PrefetchLoader(train_eval_loader, device, args.prefetch_batches)
+        val_loader = PrefetchLoader(val_loader, device, args.prefetch_batches)
+        if valB_loader:
+            valB_loader = PrefetchLoader(valB_loader, device, args.prefetch_batches)
     program_generator, pg_kwargs, pg_optimizer = None, None, None
     execution_engine, ee_kwargs, ee_optimizer = None, None, None
     baseline_model, baseline_kwargs, baseline_optimizer = None, None, None
@@ -410,7 +513,8 @@ def train_loop(args, train_loader, val_loader, valB_loader=None):
       'train_losses': [], 'train_rewards': [], 'train_losses_ts': [],
       'train_accs': [], 'val_accs': [], 'val_accs_ts': [], 'alphas' : [], 'grads' : [],
       'best_val_acc': -1, 'model_t': 0, 'model_epoch': 0,
-      'p_tree': [], 'tree_loss': [], 'chain_loss': []
+      'p_tree': [], 'tree_loss': [], 'chain_loss': [],
+      'data_seed': None, 'data_position': 0
     }
     for i in range(3):
         stats['alphas_{}'.format(i)] = []
@@ -452,6 +556,8 @@ def train_loop(args, train_loader, val_loader, valB_loader=None):
             if key in checkpoint:
                 stats[key] = checkpoint[key]
         stats['model_epoch'] -= 1
+        if train_loader.resumable_sampler is not None and stats['data_seed'] is not None:
+            train_loader.resumable_sampler.seed = stats['data_seed']
         best_pg_state = get_state(program_generator)
         best_ee_state = get_state(execution_engine)
         # no support for PG+EE her
@@ -500,6 +606,11 @@ def train_loop(args, train_loader, val_loader, valB_loader=None):
                 EMA.register('exec', name, param.data)
 
     t, epoch, reward_moving_average = stats['model_t'], stats['model_epoch'], 0
+    # Number of samples of the current epoch seen so far, used to resume mid-epoch
+    data_position = stats['data_position']
+    if train_loader.resumable_sampler is None:
+        logger.info('The training data order is not resumable, a resumed run '
+                    'starts its epoch over')
 
     set_mode('train', [program_generator, execution_engine, baseline_model])
 
@@ -525,6 +636,10 @@ def train_loop(args, train_loader, val_loader, valB_loader=None):
 
         epoch += 1
         logger.info('Starting epoch %d' % epoch)
+        if train_loader.resumable_sampler is not None:
+            train_loader.resumable_sampler.set_epoch(epoch, data_position)
+        elif isinstance(train_loader.dataset, ShardedClevrDataset):
+            train_loader.dataset.set_epoch(epoch)
 
         batch_start_time = time.time()
         for batch in train_loader:
@@ -532,10 +647,11 @@ def train_loop(args, train_loader, val_loader, valB_loader=None):
 
             t += 1
             (questions, _, feats, answers, programs, _) = batch
+            data_position += feats.size(0)
             if isinstance(questions, list):
                 questions = questions[0]
             questions_var = Variable(questions.to(device))
-            feats_var = Variable(feats.to(device))
+            feats_var = Variable(normalize_images(feats.to(device)))
             answers_var = Variable(answers.to(device))
             if programs[0] is not None:
                 programs_var = Variable(programs.to(device))
@@ -567,7 +683,7 @@ def train_loop(args, train_loader, val_loader, valB_loader=None):
 
                 loss = loss_fn(scores, answers_var)
                 _, preds = scores.data.cpu().max(1)
-                raw_reward = (preds == answers).float()
+                raw_reward = (preds == answers.cpu()).float()
                 reward_moving_average *= args.reward_decay
                 reward_moving_average += (1.0 - args.reward_decay) * raw_reward.mean()
                 centered_reward = raw_reward - reward_moving_average
@@ -735,7 +851,7 @@ def train_loop(args, train_loader, val_loader, valB_loader=None):
                 logger.info('Checking training accuracy ... ')
                 start = time.time()
                 train_acc = check_accuracy(args, program_generator, execution_engine,
-                                           baseline_model, train_loader)
+                                           baseline_model, train_eval_loader)
                 train_pass_time = (time.time() - start)
                 train_pass_total_time += train_pass_time
                 logger.info('TRAIN PASS AVG TIME: ' + str(train_pass_total_time / num_checkpoints))
@@ -775,6 +891,9 @@ def train_loop(args, train_loader, val_loader, valB_loader=None):
 
                 stats['model_t'] = t
                 stats['model_epoch'] = epoch
+                if train_loader.resumable_sampler is not None:
+                    stats['data_seed'] = train_loader.resumable_sampler.seed
+                    stats['data_position'] = data_position
 
                 checkpoint = {
                     'args': args.__dict__,
@@ -817,6 +936,8 @@ def train_loop(args, train_loader, val_loader, valB_loader=None):
                 break
 
             batch_start_time = time.time()
+        else:
+            data_position = 0
 
 
 def get_state(m):
@@ -1194,7 +1315,7 @@ def check_accuracy(args, program_generator, execution_engine, baseline_model, lo
             questions = questions[0]
 
         questions_var = questions.to(device)
-        feats_var = feats.to(device)
+        feats_var = normalize_images(feats.to(device))
         if programs[0] is not None:
             programs_var = programs.to(device)
 
@@ -1238,7 +1359,7 @@ def check_accuracy(args, program_generator, execution_engine, baseline_model, lo
 
         if scores is not None:
             _, preds = scores.data.cpu().max(1)
-            num_correct += (preds == answers).sum()
+            num_correct += (preds == answers.cpu()).sum()
             num_samples += preds.size(0)
 
         if args.num_val_samples is not None and num_samples >= args.num_val_samples:
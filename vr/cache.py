@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Copyright 2019-present, Mila
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+A node-local cache of dataset files, shared by the jobs running on a node.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+
+
+class LocalFileCache(object):
+    """
+    Copies dataset files into `cache_dir` and returns the local paths.
+
+    Entries are keyed by the absolute source path, size and modification
+    time, so that a changed source file gets a new copy. Every entry is a
+    directory holding the copy under its original name, next to a lock file:
+
+    - the first job to request a file copies it while holding a separate
+      copy lock, into a temporary file that is renamed once complete, while
+      other jobs wait on the copy lock and then use the same copy
+    - jobs hold a shared lock on the entries they use until close(), and
+      only entries that nobody holds are evicted
+    - with `max_size` (in bytes) the least recently used entries are evicted
+      to keep the cache under that size
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self._held = {}
+
+    def _key(self, path):
+        stat = os.stat(path)
+        key = '%s:%d:%d' % (path, stat.st_size, stat.st_mtime_ns)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16], stat.st_size
+
+    def _lock_path(self, entry):
+        return os.path.join(self.cache_dir, entry + '.lock')
+
+    def _copy_lock_path(self, entry):
+        return os.path.join(self.cache_dir, entry + '.copy.lock')
+
+    def _lock(self, entry, operation):
+        """
+        Opens and locks the lock file of `entry`. Returns None if the lock is
+        not available with LOCK_NB.
+        """
+        lock_path = self._lock_path(entry)
+        while True:
+            lock = open(lock_path, 'a+')
+            try:
+                fcntl.flock(lock, operation)
+            except BlockingIOError:
+                lock.close()
+                return None
+            # The entry may have been evicted and its lock file removed
+            # while we were waiting, in which case we hold a stale lock
+            if (os.path.exists(lock_path) and
+                    os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino):
+                return lock
+            lock.close()
+
+    def get(self, path):
+        """
+        Returns the path of the local copy of `path`, copying it first if
+        it is not in the cache.
+        """
+        path = os.path.abspath(path)
+        entry, size = self._key(path)
+        entry_dir = os.path.join(self.cache_dir, entry)
+        local_path = os.path.join(entry_dir, os.path.basename(path))
+        if entry in self._held:
+            return local_path
+
+        # A shared lock keeps the entry from being evicted while it is used,
+        # and lets other jobs use the same copy at the same time
+        lock = self._lock(entry, fcntl.LOCK_SH)
+        try:
+            if not os.path.exists(local_path):
+                # Only one job copies, the others wait on the copy lock, which
+                # unlike the shared locks is released as soon as the copy is
+                # done
+                with open(self._copy_lock_path(entry), 'a+') as copy_lock:
+                    fcntl.flock(copy_lock, fcntl.LOCK_EX)
+                    if not os.path.exists(local_path):
+                        self._evict(reserve=size)
+                        self._copy(path, entry_dir, local_path)
+        except BaseException:
+            lock.close()
+            raise
+        # The lock file's modification time orders entries for eviction
+        os.utime(self._lock_path(entry))
+        self._held[entry] = lock
+        return local_path
+
+    def _copy(self, path, entry_dir, local_path):
+        if os.path.exists(entry_dir):
+            # Leftovers of a copy that was interrupted
+            shutil.rmtree(entry_dir)
+        os.makedirs(entry_dir)
+        tmp_path = '%s.%d.tmp' % (local_path, os.getpid())
+        print('Copying %s to %s' % (path, local_path))
+        shutil.copyfile(path, tmp_path)
+        shutil.copystat(path, tmp_path)
+        os.rename(tmp_path, local_path)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            lock_path = self._lock_path(name)
+            if not os.path.isdir(entry_dir) or not os.path.exists(lock_path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, f))
+                           for f in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(lock_path), name, size))
+            except OSError:
+                # Removed by a concurrent eviction
+                continue
+        return sorted(entries)
+
+    def _evict(self, reserve=0):
+        """
+        Removes the least recently used entries that no job holds until the
+        cache has room for `reserve` more bytes under max_size.
+        """
+        if self.max_size is None:
+            return
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+        for _, name, size in entries:
+            if total + reserve <= self.max_size:
+                break
+            if name in self._held:
+                continue
+            lock = self._lock(name, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if lock is None:
+                # In use by another job
+                continue
+            with lock:
+                print('Evicting %s from %s' % (name, self.cache_dir))
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+                os.remove(self._lock_path(name))
+                if os.path.exists(self._copy_lock_path(name)):
+                    os.remove(self._copy_lock_path(name))
+            total -= size
+
+    def close(self):
+        for lock in self._held.values():
+            lock.close()
+        self._held = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -10,21 +10,317 @@
 import numpy as np
 import PIL.Image
 import h5py
+import fcntl
+import glob
 import io
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import (Dataset, IterableDataset, ConcatDataset, DataLoader, Sampler,
+                              BatchSampler, RandomSampler, SequentialSampler)
 from torch.utils.data.dataloader import default_collate
 import random, math
 import vr.programs
 from vr.programs import ProgramConverter
 
 
-def _dataset_to_tensor(dset, mask=None, dtype=None):
-    arr = np.asarray(dset, dtype=np.int64 if dtype is None else dtype)
-    if mask is not None:
-        arr = arr[mask]
-    tensor = torch.LongTensor(arr)
-    return tensor
+def _dataset_to_tensor(dset, mask=None, dtype=None, chunk_size=2 ** 16):
+    """
+    Reads an h5 dataset, or only the rows selected by the boolean `mask`,
+    into a tensor. Selected rows are converted chunk by chunk straight into
+    one preallocated array, so the unmasked dataset is never materialized
+    and chunks without selected rows are not read at all.
+    """
+    dtype = np.int64 if dtype is None else dtype
+    if mask is None:
+        return torch.from_numpy(dset[()].astype(dtype, copy=False))
+    if dset.chunks is not None:
+        # Align the reads with the h5 chunks
+        chunk_size = max(chunk_size // dset.chunks[0], 1) * dset.chunks[0]
+    arr = np.empty((int(mask.sum()),) + dset.shape[1:], dtype=dtype)
+    position = 0
+    for start in range(0, dset.shape[0], chunk_size):
+        chunk_mask = mask[start:start + chunk_size]
+        num_selected = int(chunk_mask.sum())
+        if num_selected == 0:
+            continue
+        arr[position:position + num_selected] = dset[start:start + len(chunk_mask)][chunk_mask]
+        position += num_selected
+    return torch.from_numpy(arr)
+
+def _decode_png(blob):
+    return np.array(PIL.Image.open(io.BytesIO(blob))).transpose(2, 0, 1)
+
+
+_decode_pool = None
+
+
+def _get_decode_pool(num_threads):
+    # Threads do not survive fork, so every worker process builds its own pool
+    global _decode_pool
+    if _decode_pool is None or _decode_pool[0] != (os.getpid(), num_threads):
+        _decode_pool = ((os.getpid(), num_threads), ThreadPoolExecutor(num_threads))
+    return _decode_pool[1]
+
+
+def decode_png_batch(blobs, num_threads=1, dtype=np.float32, out=None):
+    """
+    Decodes a batch of PNG blobs straight into one preallocated N x C x H x W
+    tensor, spreading the work over a thread pool (PIL releases the GIL while
+    decoding). Float outputs are scaled to [0, 1]. If `out` is given, the
+    images are written into it instead of a newly allocated tensor.
+    """
+    if out is None:
+        first = PIL.Image.open(io.BytesIO(blobs[0]))
+        width, height = first.size
+        out = torch.from_numpy(np.empty((len(blobs), len(first.getbands()), height, width),
+                                        dtype=dtype))
+        if torch.utils.data.get_worker_info() is not None:
+            # The batch will be sent to the main process through shared memory
+            out.share_memory_()
+    out_array = out.numpy()
+
+    def decode(i):
+        image = np.asarray(PIL.Image.open(io.BytesIO(blobs[i]))).transpose(2, 0, 1)
+        if out_array.dtype == np.uint8:
+            out_array[i] = image
+        else:
+            np.divide(image, 255.0, out=out_array[i])
+
+    if num_threads > 1:
+        list(_get_decode_pool(num_threads).map(decode, range(len(blobs))))
+    else:
+        for i in range(len(blobs)):
+            decode(i)
+    return out
+
+
+def normalize_images(feats):
+    """
+    Converts a batch of uint8 images, as loaded with uint8_images=True, to
+    floats in [0, 1]. Meant to be applied once the batch is on the compute
+    device; other features are returned unchanged.
+    """
+    if feats.dtype == torch.uint8:
+        return feats.float().div_(255.0)
+    return feats
+
+
+def decoded_cache_path(feature_h5_path):
+    """
+    Returns the location of the decoded image cache for a features file,
+    e.g. train_features.h5 -> train_features_decoded.npy
+    """
+    return os.path.splitext(feature_h5_path)[0] + '_decoded.npy'
+
+
+def _source_signature(feature_h5_path):
+    stat = os.stat(feature_h5_path)
+    return '%d:%d' % (stat.st_size, stat.st_mtime_ns)
+
+
+def decoded_cache_is_current(feature_h5_path, cache_path=None):
+    """
+    Returns whether the decoded cache of `feature_h5_path` exists and was
+    built from the current version of that file, as recorded by the size and
+    modification time kept in a .source file next to the cache.
+    """
+    if cache_path is None:
+        cache_path = decoded_cache_path(feature_h5_path)
+    if not os.path.exists(cache_path) or not os.path.exists(cache_path + '.source'):
+        return False
+    with open(cache_path + '.source') as f:
+        return f.read() == _source_signature(feature_h5_path)
+
+
+def build_decoded_cache(feature_h5_path, cache_path=None, chunk_size=1024, overwrite=True):
+    """
+    Decodes all PNG-compressed images in `feature_h5_path` into a single
+    contiguous uint8 N x C x H x W array saved as a .npy file, so that it can
+    later be opened with np.load(..., mmap_mode='r'). Images stored raw are
+    copied as they are.
+    Builds are serialized with a lock file, so that jobs started together
+    decode the file once; with overwrite=False, a cache that is current by
+    the time the lock is taken is kept. The cache is written under a
+    temporary name and renamed when complete, and its .source file, see
+    decoded_cache_is_current, is only written after that.
+    """
+    if cache_path is None:
+        cache_path = decoded_cache_path(feature_h5_path)
+    with open(cache_path + '.lock', 'a+') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not overwrite and decoded_cache_is_current(feature_h5_path, cache_path):
+            return cache_path
+        _write_decoded_cache(feature_h5_path, cache_path, chunk_size)
+    return cache_path
+
+
+def _write_decoded_cache(feature_h5_path, cache_path, chunk_size):
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    # Taken before reading, so that a file changed meanwhile is decoded again
+    signature = _source_signature(feature_h5_path)
+    with h5py.File(feature_h5_path, 'r') as feature_h5:
+        features = feature_h5['features']
+        num_images = features.shape[0]
+        png = features.dtype == object
+        if not png and features.dtype != np.uint8:
+            raise ValueError('%s holds %s features, only PNG-compressed or uint8 images '
+                             'can be cached' % (feature_h5_path, features.dtype))
+        image_shape = _decode_png(features[0]).shape if png else features.shape[1:]
+        cache = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                          shape=(num_images,) + image_shape)
+        for start in range(0, num_images, chunk_size):
+            blobs = features[start:start + chunk_size]
+            if not png:
+                cache[start:start + len(blobs)] = blobs
+                continue
+            for i, blob in enumerate(blobs):
+                cache[start + i] = _decode_png(blob)
+        cache.flush()
+        del cache
+    # The old cache must not pass for current while it is being replaced
+    if os.path.exists(cache_path + '.source'):
+        os.remove(cache_path + '.source')
+    os.rename(tmp_path, cache_path)
+    with open(tmp_path, 'w') as f:
+        f.write(signature)
+    os.rename(tmp_path, cache_path + '.source')
+
+
+class PackedBlobs(object):
+    """
+    Variable-length byte strings (e.g. PNG-compressed images) packed into one
+    flat uint8 buffer, with blob i stored at data[offsets[i]:offsets[i + 1]].
+    Once moved to shared memory, the store is pickled to workers as two
+    handles instead of one Python object per blob.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self._data = None
+        self._offsets = None
+
+    def share_memory_(self):
+        self.data.share_memory_()
+        self.offsets.share_memory_()
+        return self
+
+    @classmethod
+    def from_h5(cls, dataset, chunk_size=4096):
+        chunks = []
+        lengths = np.zeros(dataset.shape[0], dtype=np.int64)
+        for start in range(0, dataset.shape[0], chunk_size):
+            blobs = dataset[start:start + chunk_size]
+            lengths[start:start + len(blobs)] = [len(blob) for blob in blobs]
+            chunks.append(np.concatenate(blobs))
+        offsets = np.zeros(dataset.shape[0] + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        data = torch.from_numpy(np.concatenate(chunks)) if chunks else torch.ByteTensor()
+        return cls(data, torch.from_numpy(offsets))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_offsets'] = None
+        return state
+
+    def __len__(self):
+        return self.offsets.size(0) - 1
+
+    def __getitem__(self, index):
+        if self._data is None:
+            self._data = self.data.numpy()
+            self._offsets = self.offsets.numpy()
+        if np.ndim(index) == 0:
+            index = int(index)
+            return self._data[self._offsets[index]:self._offsets[index + 1]]
+        blobs = np.empty(len(index), dtype=object)
+        for i, j in enumerate(index):
+            blobs[i] = self._data[self._offsets[j]:self._offsets[j + 1]]
+        return blobs
+
+
+def write_shards(question_h5_path, feature_h5_path, output_prefix, shard_size=10000):
+    """
+    Converts a pair of *_questions.h5 / *_features.h5 files into shard files
+    {output_prefix}-00000-of-00042.h5 of `shard_size` questions each. Every
+    shard holds the questions, programs and answers of its rows together with
+    their images, PNG blobs being packed into one flat `image_data` buffer
+    indexed by `image_offsets`, so that a shard is read sequentially in one go.
+    """
+    paths = []
+    with h5py.File(question_h5_path, 'r') as question_h5, \
+         h5py.File(feature_h5_path, 'r') as feature_h5:
+        features = feature_h5['features']
+        all_image_idxs = np.asarray(question_h5['image_idxs'])
+        num_questions = all_image_idxs.shape[0]
+        num_shards = max(int(math.ceil(num_questions / shard_size)), 1)
+        for shard in range(num_shards):
+            start, end = shard * shard_size, min((shard + 1) * shard_size, num_questions)
+            path = '%s-%05d-of-%05d.h5' % (output_prefix, shard, num_shards)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            image_idxs = all_image_idxs[start:end]
+            unique_idxs, inverse = np.unique(image_idxs, return_inverse=True)
+            if len(unique_idxs) and unique_idxs[-1] - unique_idxs[0] + 1 == len(unique_idxs):
+                # Contiguous images, as in SQOOP, are read with one slice
+                feats = features[unique_idxs[0]:unique_idxs[-1] + 1]
+            else:
+                feats = features[unique_idxs]
+            with h5py.File(tmp_path, 'w') as dst:
+                for name in ['questions', 'programs', 'answers', 'types', 'question_families']:
+                    if name in question_h5:
+                        dst.create_dataset(name, data=question_h5[name][start:end])
+                dst.create_dataset('image_idxs', data=image_idxs)
+                if features.dtype == object:
+                    blobs = [feats[i] for i in inverse]
+                    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+                    np.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+                    data = np.concatenate(blobs) if blobs else np.zeros(0, dtype=np.uint8)
+                    dst.create_dataset('image_data', data=data)
+                    dst.create_dataset('image_offsets', data=offsets)
+                else:
+                    dst.create_dataset('features', data=feats[inverse])
+            os.rename(tmp_path, path)
+            paths.append(path)
+    return paths
+
+
+def _read_rows(dset, idxs, max_span=4):
+    """
+    Reads the rows `idxs` (sorted and unique) of an h5 dataset. Rows are
+    grouped into runs that span at most `max_span` times as many rows as
+    they select, e.g. the blocks of BlockShuffleSampler with few enough
+    window_blocks, and every run is read with one contiguous slice. The
+    remaining rows are read together with a single fancy-indexed call.
+    """
+    if len(idxs) < 2:
+        return dset[idxs]
+    runs = [[0, 1]]
+    for i in range(1, len(idxs)):
+        start = runs[-1][0]
+        if idxs[i] - idxs[start] + 1 <= max_span * (i - start + 1):
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1])
+    if all(end - start == 1 for start, end in runs):
+        return dset[idxs]
+    sparse = np.concatenate([np.arange(start, end) for start, end in runs if end - start == 1]
+                            or [np.zeros(0, dtype=np.int64)])
+    sparse_rows = dset[idxs[sparse]] if len(sparse) else None
+    parts, position = [], 0
+    for start, end in runs:
+        if end - start == 1:
+            parts.append(sparse_rows[position:position + 1])
+            position += 1
+        else:
+            run = idxs[start:end]
+            parts.append(dset[run[0]:run[-1] + 1][run - run[0]])
+    return np.concatenate(parts)
+
 
 def _gen_subsample_mask(num, percent=1.0):
     chosen_num = math.floor(num * percent)
@@ -37,7 +333,8 @@ def _gen_subsample_mask(num, percent=1.0):
 class ClevrDataset(Dataset):
     def __init__(self, question_h5, feature_h5_path, vocab, mode='prefix',
                  image_h5=None, load_features=False, max_samples=None, question_families=None,
-                 image_idx_start_from=None, percent_of_data=1.0):
+                 image_idx_start_from=None, percent_of_data=1.0, decoded_cache=False,
+                 build_program_json=False, decode_threads=0, uint8_images=False):
         mode_choices = ['prefix', 'postfix']
         if mode not in mode_choices:
             raise ValueError('Invalid mode "%s"' % mode)
@@ -46,10 +343,30 @@ class ClevrDataset(Dataset):
         self.program_converter = ProgramConverter(vocab)
         self.feature_h5_path = feature_h5_path
         self.feature_h5 = None
+        self.features = None
         self.all_features = None
         self.load_features = load_features
         self.mode = mode
         self.max_samples = max_samples
+        self.build_program_json = build_program_json
+        self._program_json_cache = {}
+        # With decode_threads > 0, PNG blobs are returned undecoded by
+        # __getitem__ and decoded a batch at a time in clevr_collate
+        self.decode_threads = decode_threads
+        # With uint8_images, images are returned as uint8 and only converted
+        # to float on the compute device, see normalize_images
+        self.uint8_images = uint8_images
+
+        # Decoded images are kept in a .npy file next to the features and
+        # memory-mapped lazily, so that workers and concurrent jobs share
+        # one copy through the OS page cache
+        self.decoded_cache_path = None
+        self.decoded_images = None
+        if decoded_cache:
+            self.decoded_cache_path = decoded_cache_path(feature_h5_path)
+            if not decoded_cache_is_current(feature_h5_path, self.decoded_cache_path):
+                print('Building decoded image cache ', self.decoded_cache_path)
+                build_decoded_cache(feature_h5_path, self.decoded_cache_path, overwrite=False)
 
         # Compute the mask
         mask = None
@@ -64,7 +381,7 @@ class ClevrDataset(Dataset):
             all_image_idxs = np.asarray(question_h5['image_idxs'])
             mask = all_image_idxs >= image_idx_start_from
         if percent_of_data < 1.0:
-            num_example = np.asarray(question_h5['image_idxs']).shape[0]
+            num_example = question_h5['image_idxs'].shape[0]
             mask = _gen_subsample_mask(num_example, percent_of_data)
         self.mask = mask
 
@@ -85,12 +402,126 @@ class ClevrDataset(Dataset):
         if 'answers' in question_h5:
             self.all_answers = _dataset_to_tensor(question_h5['answers'], mask)
 
-    def __getitem__(self, index):
-        # Open the feature or load them if requested
-        if not self.feature_h5:
+        # Features are preloaded once here rather than in every worker, see
+        # share_memory for how workers get them
+        if self.load_features and self.decoded_cache_path is None:
+            print('Reading features into memory')
+            with h5py.File(feature_h5_path, 'r') as feature_h5:
+                if feature_h5['features'].dtype == object:
+                    # PNG blobs stay compressed and are decoded on demand
+                    self.all_features = PackedBlobs.from_h5(feature_h5['features'])
+                else:
+                    features = feature_h5['features'][()]
+                    self.all_features = torch.from_numpy(features)
+
+    def share_memory(self):
+        """
+        Moves the preloaded tensors to shared memory, so that loader workers
+        attach to them without copying, whether they are forked or spawned.
+        Only worth it when workers are started, as it copies every tensor.
+        """
+        for tensor in [self.all_types, self.all_question_families, self.all_questions,
+                       self.all_image_idxs, self.all_programs, self.all_answers,
+                       self.all_features]:
+            if tensor is not None:
+                tensor.share_memory_()
+
+    def __getstate__(self):
+        # File handles and views are per process and are reopened lazily
+        state = self.__dict__.copy()
+        state['feature_h5'] = None
+        state['features'] = None
+        state['decoded_images'] = None
+        return state
+
+    def _open_features(self):
+        if self.decoded_cache_path is not None:
+            if self.decoded_images is None:
+                self.decoded_images = np.load(self.decoded_cache_path, mmap_mode='r')
+        elif self.load_features:
+            if self.features is None:
+                self.features = self.all_features
+                if torch.is_tensor(self.features):
+                    self.features = self.features.numpy()
+        elif not self.feature_h5:
             self.feature_h5 = h5py.File(self.feature_h5_path, 'r')
-            if self.load_features:
-                self.features = self.feature_h5['features'].value
+
+    def _read_raw_features(self, image_idxs):
+        """
+        Reads the features of a sorted array of unique image indices, see
+        _read_rows. Images, whether PNG-compressed or stored raw, are
+        returned stacked as uint8, precomputed features as float32.
+        """
+        if self.decoded_cache_path is not None:
+            return self.decoded_images[image_idxs]
+        if self.load_features:
+            feats = self.features[image_idxs]
+        else:
+            feats = _read_rows(self.feature_h5['features'], image_idxs)
+        if feats.dtype == object:
+            return decode_png_batch(feats, max(self.decode_threads, 1), np.uint8).numpy()
+        if feats.dtype == np.uint8:
+            return np.asarray(feats)
+        return np.asarray(feats, dtype=np.float32)
+
+    def _read_features(self, image_idxs):
+        feats = self._read_raw_features(image_idxs)
+        if feats.dtype == np.uint8 and not self.uint8_images:
+            feats = feats / np.float32(255.0)
+        return feats
+
+    def load_to_device(self, device, chunk_size=1024):
+        """
+        Loads the whole dataset into contiguous tensors on `device`. Images
+        are stored as uint8 and only converted to float when a batch is
+        gathered, see ClevrDataLoader.
+        """
+        self._open_features()
+        num_samples = len(self)
+        image_idxs, image_positions = np.unique(
+            self.all_image_idxs[:num_samples].numpy(), return_inverse=True)
+        feats = [torch.from_numpy(self._read_raw_features(image_idxs[start:start + chunk_size]))
+                 for start in range(0, len(image_idxs), chunk_size)]
+
+        def to_device(tensor):
+            return None if tensor is None else tensor[:num_samples].to(device)
+        self.device_data = {
+            'questions': to_device(self.all_questions),
+            'types': to_device(self.all_types),
+            'answers': to_device(self.all_answers),
+            'programs': to_device(self.all_programs),
+            'feats': torch.cat(feats).to(device),
+            'image_positions': torch.from_numpy(image_positions).to(device),
+        }
+
+    def program_json(self, program_seq):
+        """
+        Converts a program token sequence into its list representation.
+        Results are memoized per token sequence and shared between samples,
+        so callers must not modify them.
+        """
+        key = tuple(program_seq.tolist())
+        if key not in self._program_json_cache:
+            self._program_json_cache[key] = self._convert_program(program_seq)
+        return self._program_json_cache[key]
+
+    def _convert_program(self, program_seq):
+        program_json_seq = []
+        for fn_idx in program_seq:
+            fn_str = self.vocab['program_idx_to_token'][fn_idx.item()]
+            if fn_str == '<START>' or fn_str == '<END>':
+                continue
+            fn = vr.programs.str_to_function(fn_str)
+            program_json_seq.append(fn)
+        if self.mode == 'prefix':
+            return self.program_converter.prefix_to_list(program_json_seq)
+        elif self.mode == 'postfix':
+            return self.program_converter.to_list(program_json_seq)
+
+    def __getitem__(self, index):
+        if isinstance(index, (list, tuple)):
+            return self._get_batch(index)
+        self._open_features()
 
         if self.all_question_families is not None:
             question_family = self.all_question_families[index]
@@ -109,32 +540,73 @@ class ClevrDataset(Dataset):
             image = self.image_h5['images'][image_idx]
             image = torch.FloatTensor(np.asarray(image, dtype=np.float32))
 
-        if self.load_features:
-            feats = self.features[image_idx]
+        if self.decoded_cache_path is not None:
+            feats = self.decoded_images[image_idx]
         else:
-            feats = self.feature_h5['features'][image_idx]
-        if feats.ndim == 1:
-            feats = np.array(PIL.Image.open(io.BytesIO(feats))).transpose(2, 0, 1) / 255.0
-        feats = torch.FloatTensor(np.asarray(feats, dtype=np.float32))
+            if self.load_features:
+                feats = self.features[image_idx]
+            else:
+                feats = self.feature_h5['features'][image_idx]
+            if feats.ndim == 1:
+                if self.decode_threads > 0:
+                    feats = np.asarray(feats)
+                else:
+                    feats = _decode_png(feats)
+        if feats.ndim > 1:
+            if feats.dtype == np.uint8 and self.uint8_images:
+                feats = torch.from_numpy(np.array(feats))
+            elif feats.dtype == np.uint8:
+                feats = torch.FloatTensor(feats / np.float32(255.0))
+            else:
+                feats = torch.FloatTensor(np.asarray(feats, dtype=np.float32))
 
         program_json = None
-        if program_seq is not None:
-            program_json_seq = []
-            for fn_idx in program_seq:
-                fn_str = self.vocab['program_idx_to_token'][fn_idx.item()]
-                if fn_str == '<START>' or fn_str == '<END>':
-                    continue
-                fn = vr.programs.str_to_function(fn_str)
-                program_json_seq.append(fn)
-            if self.mode == 'prefix':
-                program_json = self.program_converter.prefix_to_list(program_json_seq)
-            elif self.mode == 'postfix':
-                program_json = self.program_converter.to_list(program_json_seq)
+        if program_seq is not None and self.build_program_json:
+            program_json = self.program_json(program_seq)
 
         if q_type is None:
             return (question, image, feats, answer, program_seq, program_json)
         return ([question, q_type], image, feats, answer, program_seq, program_json)
 
+    def _get_batch(self, indices):
+        """
+        Fetches a whole batch given a list of indices and returns it already
+        stacked, in the same format as clevr_collate. The image indices are
+        sorted and deduplicated so that features are read with one call.
+        """
+        self._open_features()
+        batch_size = len(indices)
+        indices = torch.LongTensor(indices)
+
+        question = self.all_questions[indices]
+        if self.all_types is not None:
+            question = [question, self.all_types[indices]]
+        answer = (None,) * batch_size
+        if self.all_answers is not None:
+            answer = self.all_answers[indices]
+        program_seq = (None,) * batch_size
+        if self.all_programs is not None:
+            program_seq = self.all_programs[indices]
+
+        image_idxs, inverse = np.unique(self.all_image_idxs[indices].numpy(),
+                                        return_inverse=True)
+        image = (None,) * batch_size
+        if self.image_h5 is not None:
+            image = np.asarray(self.image_h5['images'][image_idxs], dtype=np.float32)
+            image = torch.FloatTensor(image[inverse])
+        feats = torch.from_numpy(np.ascontiguousarray(self._read_features(image_idxs)[inverse]))
+
+        program_json = (None,) * batch_size
+        if self.all_programs is not None and self.build_program_json:
+            program_json = tuple(self.program_json(seq) for seq in program_seq)
+
+        return [question, image, feats, answer, program_seq, program_json]
+
+    def question_lengths(self):
+        """Number of non-<NULL> tokens of every question."""
+        null = self.vocab['question_token_to_idx']['<NULL>']
+        return (self.all_questions[:len(self)] != null).sum(1).numpy()
+
     def __len__(self):
         if self.max_samples is None:
             return self.all_questions.size(0)
@@ -142,44 +614,704 @@ class ClevrDataset(Dataset):
             return min(self.max_samples, self.all_questions.size(0))
 
 
+class ClevrUnionDataset(ConcatDataset):
+    """
+    Presents several ClevrDatasets, e.g. SQOOP variants with different
+    rhs_variety, as one dataset without copying their files. Sample i of
+    source k has the index offsets[k] + i. Questions and programs are padded
+    with <NULL> to the same length in all sources.
+    """
+
+    def __init__(self, datasets):
+        super(ClevrUnionDataset, self).__init__(datasets)
+        self.offsets = [0] + self.cumulative_sizes[:-1]
+        vocab = datasets[0].vocab
+        for name, token_to_idx in [('all_questions', 'question_token_to_idx'),
+                                   ('all_programs', 'program_token_to_idx')]:
+            tensors = [getattr(dataset, name) for dataset in datasets]
+            if any(tensor is None for tensor in tensors):
+                continue
+            null = vocab[token_to_idx]['<NULL>']
+            length = max(tensor.size(1) for tensor in tensors)
+            for dataset, tensor in zip(datasets, tensors):
+                if tensor.size(1) < length:
+                    tensor = torch.cat([tensor, tensor.new_full((tensor.size(0),
+                                                                 length - tensor.size(1)),
+                                                                null)], 1)
+                    setattr(dataset, name, tensor)
+        first = datasets[0]
+        self.vocab = first.vocab
+        self.decode_threads = first.decode_threads
+        self.uint8_images = first.uint8_images
+        self.build_program_json = first.build_program_json
+        # Used to align BlockShuffleSampler blocks with the h5 chunks
+        self.feature_h5_path = first.feature_h5_path
+
+    @property
+    def all_questions(self):
+        return torch.cat([dataset.all_questions[:len(dataset)] for dataset in self.datasets])
+
+    def question_lengths(self):
+        return np.concatenate([dataset.question_lengths() for dataset in self.datasets])
+
+    def share_memory(self):
+        for dataset in self.datasets:
+            dataset.share_memory()
+
+    def __getitem__(self, index):
+        if isinstance(index, (list, tuple)):
+            return self._get_batch(index)
+        return super(ClevrUnionDataset, self).__getitem__(index)
+
+    def _get_batch(self, indices):
+        """
+        Fetches the indices of every source with one ClevrDataset._get_batch
+        call and merges the batches back into the order of `indices`.
+        """
+        indices = np.asarray(indices)
+        sources = np.searchsorted(self.cumulative_sizes, indices, side='right')
+        batches, positions = [], []
+        for source in np.unique(sources):
+            which = np.flatnonzero(sources == source)
+            batches.append(self.datasets[source]._get_batch(
+                (indices[which] - self.offsets[source]).tolist()))
+            positions.append(which)
+        order = np.argsort(np.concatenate(positions))
+        return [_merge_batches([batch[i] for batch in batches], order)
+                for i in range(len(batches[0]))]
+
+
+def _merge_batches(fields, order):
+    first = fields[0]
+    if torch.is_tensor(first):
+        return torch.cat(fields)[torch.from_numpy(order)]
+    if isinstance(first, list):
+        return [_merge_batches([field[j] for field in fields], order)
+                for j in range(len(first))]
+    merged = sum((tuple(field) for field in fields), ())
+    return tuple(merged[i] for i in order)
+
+
+class ShardedClevrDataset(IterableDataset):
+    """
+    Streams samples from shard files written by write_shards. Shards are
+    split between workers and read whole, one at a time, in an order shuffled
+    per epoch (see set_epoch); samples then go through a shuffle buffer of
+    `shuffle_buffer` entries. Samples have the same layout as those of
+    ClevrDataset.
+    """
+
+    def __init__(self, shard_paths, shuffle=False, shuffle_buffer=10000, seed=None,
+                 decode_threads=0, uint8_images=False):
+        self.shard_paths = sorted(shard_paths)
+        if not self.shard_paths:
+            raise ValueError('No shards given')
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        if seed is None:
+            seed = random.randint(0, 2 ** 31 - 1)
+        self.seed = seed
+        self.epoch = 0
+        self.decode_threads = decode_threads
+        self.uint8_images = uint8_images
+        self.num_samples = 0
+        for path in self.shard_paths:
+            with h5py.File(path, 'r') as shard:
+                self.num_samples += shard['questions'].shape[0]
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        # Every epoch gets a new shard order and shuffle buffer sequence
+        self.epoch = epoch
+
+    def _read_shard(self, path):
+        # Images are yielded as stored, i.e. as PNG blob views or raw rows,
+        # and only converted by _decode once they leave the shuffle buffer
+        with h5py.File(path, 'r') as shard:
+            data = {name: shard[name][()] for name in shard}
+        num_rows = data['questions'].shape[0]
+        packed = 'image_data' in data
+        for i in range(num_rows):
+            if packed:
+                feats = data['image_data'][data['image_offsets'][i]:data['image_offsets'][i + 1]]
+            else:
+                feats = data['features'][i]
+            question = torch.LongTensor(data['questions'][i].astype(np.int64))
+            if 'types' in data:
+                question = [question, torch.tensor(int(data['types'][i]))]
+            answer = None
+            if 'answers' in data:
+                answer = torch.tensor(int(data['answers'][i]))
+            program_seq = None
+            if 'programs' in data:
+                program_seq = torch.LongTensor(data['programs'][i].astype(np.int64))
+            yield (question, None, feats, answer, program_seq, None)
+
+    def _decode(self, sample):
+        feats = sample[2]
+        if feats.ndim == 1:
+            if self.decode_threads > 0:
+                # Decoded a batch at a time in clevr_collate
+                return sample
+            feats = _decode_png(feats)
+        if feats.dtype == np.uint8 and self.uint8_images:
+            feats = torch.from_numpy(np.array(feats))
+        elif feats.dtype == np.uint8:
+            feats = torch.FloatTensor(feats / np.float32(255.0))
+        else:
+            feats = torch.FloatTensor(np.asarray(feats, dtype=np.float32))
+        return sample[:2] + (feats,) + sample[3:]
+
+    def __iter__(self):
+        return map(self._decode, self._iter_raw())
+
+    def _iter_raw(self):
+        rng = np.random.RandomState([self.seed, self.epoch])
+        shard_paths = list(self.shard_paths)
+        if self.shuffle:
+            rng.shuffle(shard_paths)
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            shard_paths = shard_paths[worker_info.id::worker_info.num_workers]
+            rng = np.random.RandomState([self.seed, self.epoch, worker_info.id])
+
+        buffer = []
+        for path in shard_paths:
+            for sample in self._read_shard(path):
+                if not self.shuffle:
+                    yield sample
+                elif len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                else:
+                    i = rng.randint(len(buffer))
+                    yield buffer[i]
+                    buffer[i] = sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+
+class _EpochSampler(Sampler):
+    """
+    Base of the samplers whose order is a function of (seed, epoch) only, so
+    that a resumed run sees the same data order as the interrupted one.
+    set_epoch(epoch, position) makes the next pass start `position` samples
+    into that epoch.
+    """
+
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = random.randint(0, 2 ** 31 - 1)
+        self.seed = seed
+        self.epoch = 0
+        self.position = 0
+
+    def set_epoch(self, epoch, position=0):
+        self.epoch = epoch
+        self.position = position
+
+    def _rng(self):
+        return np.random.RandomState([self.seed, self.epoch])
+
+    def _take_position(self):
+        # The position only applies to the first pass after set_epoch.
+        # __iter__ must be a generator calling this, so that iterators that
+        # are created but never advanced, as DataLoader does with workers,
+        # do not use up the position
+        position, self.position = self.position, 0
+        return position
+
+
+class ResumableSampler(_EpochSampler):
+    """Random permutation of the whole dataset, or its order with shuffle=False."""
+
+    def __init__(self, data_source, seed=None, shuffle=True):
+        super(ResumableSampler, self).__init__(seed)
+        self.data_source = data_source
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        if not self.shuffle:
+            yield from range(self._take_position(), len(self.data_source))
+            return
+        order = self._rng().permutation(len(self.data_source))
+        yield from order[self._take_position():].tolist()
+
+    def __len__(self):
+        return len(self.data_source) - self.position
+
+
+class SourceWeightedSampler(_EpochSampler):
+    """
+    Draws `num_samples` samples with replacement from a ClevrUnionDataset,
+    picking source k with probability proportional to weights[k] and then a
+    sample of it uniformly.
+    """
+
+    def __init__(self, data_source, weights, num_samples=None, seed=None):
+        super(SourceWeightedSampler, self).__init__(seed)
+        if len(weights) != len(data_source.datasets):
+            raise ValueError('Must give one weight per source')
+        self.sizes = np.diff([0] + data_source.cumulative_sizes)
+        self.probs = np.asarray(weights, dtype=np.float64) / self.sizes
+        self.probs = np.repeat(self.probs / self.probs.dot(self.sizes), self.sizes)
+        if num_samples is None:
+            num_samples = len(data_source)
+        self.num_samples = num_samples
+
+    def __iter__(self):
+        order = self._rng().choice(len(self.probs), self.num_samples, p=self.probs)
+        yield from order[self._take_position():].tolist()
+
+    def __len__(self):
+        return self.num_samples - self.position
+
+
+class BlockShuffleSampler(_EpochSampler):
+    """
+    Shuffles contiguous blocks of `block_size` samples (e.g. the rows of an
+    h5 chunk), then the samples within windows of `window_blocks` blocks, so
+    that a batch reads from at most window_blocks blocks.
+    """
+
+    def __init__(self, data_source, block_size, window_blocks=16, seed=None):
+        super(BlockShuffleSampler, self).__init__(seed)
+        self.data_source = data_source
+        self.block_size = block_size
+        self.window_blocks = window_blocks
+
+    def __iter__(self):
+        rng = self._rng()
+        num_samples = len(self.data_source)
+        blocks = np.arange(0, num_samples, self.block_size)
+        rng.shuffle(blocks)
+        order = []
+        for start in range(0, len(blocks), self.window_blocks):
+            window = np.concatenate([np.arange(block, min(block + self.block_size, num_samples))
+                                     for block in blocks[start:start + self.window_blocks]])
+            order.append(rng.permutation(window))
+        order = np.concatenate(order) if order else np.arange(0)
+        yield from order[self._take_position():].tolist()
+
+    def __len__(self):
+        return len(self.data_source) - self.position
+
+
+class LengthBucketBatchSampler(_EpochSampler):
+    """
+    Batch sampler that sorts windows of `bucket_batches` batches by question
+    length before cutting them into batches, so that little of every batch
+    is padding. With shuffle=True, samples and batches are shuffled too.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_batches=100, shuffle=True,
+                 drop_last=False, seed=None):
+        super(LengthBucketBatchSampler, self).__init__(seed)
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def _batches(self):
+        rng = self._rng()
+        order = np.arange(len(self.lengths))
+        if self.shuffle:
+            order = rng.permutation(order)
+        window = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(order), window):
+            bucket = order[start:start + window]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size]
+                           for i in range(0, len(bucket), self.batch_size))
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        yield from _skip_samples(self._batches(), self._take_position())
+
+    def __len__(self):
+        num_samples = len(self.lengths) - self.position
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return (num_samples + self.batch_size - 1) // self.batch_size
+
+
+def _skip_samples(batches, position):
+    # Yields the batches as lists, starting `position` samples in
+    for batch in batches:
+        if position >= len(batch):
+            position -= len(batch)
+            continue
+        yield batch[position:].tolist()
+        position = 0
+
+
+class PairIndex(object):
+    """
+    Maps every (lhs, rel, rhs) question triple to the dataset rows asking
+    it, built with a single sort of the question tensor. `columns` are the
+    positions of lhs, rel and rhs in the questions, which SQOOP writes as
+    [x, rel, y]. The rows of triple i are rows[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, questions, columns=(0, 1, 2)):
+        triples = np.asarray(questions)[:, list(columns)]
+        self.triples, inverse, counts = np.unique(triples, axis=0, return_inverse=True,
+                                                  return_counts=True)
+        self.rows = np.argsort(inverse.reshape(-1), kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self._ids = {tuple(triple): i for i, triple in enumerate(self.triples.tolist())}
+
+    def __len__(self):
+        return len(self.triples)
+
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def rows_of(self, triple_id):
+        return self.rows[self.offsets[triple_id]:self.offsets[triple_id + 1]]
+
+    def select(self, patterns):
+        """
+        Returns the ids of the triples matching any of `patterns`, which are
+        (lhs, rel, rhs) token ids with None matching any token.
+        """
+        selected = np.zeros(len(self.triples), dtype=bool)
+        for pattern in patterns:
+            match = np.ones(len(self.triples), dtype=bool)
+            for column, token in enumerate(pattern):
+                if token is not None:
+                    match &= self.triples[:, column] == token
+            selected |= match
+        return np.flatnonzero(selected)
+
+
+class PairBatchSampler(_EpochSampler):
+    """
+    Batch sampler over the rows of a subset of the triples of a PairIndex
+    (all of them by default). 'stratified' draws every row once per epoch,
+    each batch holding the triples in proportion to their number of rows;
+    'balanced' draws rows with replacement, each triple equally likely.
+    """
+
+    def __init__(self, pair_index, batch_size, triple_ids=None, mode='stratified',
+                 drop_last=False, seed=None):
+        super(PairBatchSampler, self).__init__(seed)
+        if mode not in ['stratified', 'balanced']:
+            raise ValueError('Invalid mode "%s"' % mode)
+        if triple_ids is None:
+            triple_ids = np.arange(len(pair_index))
+        self.triple_ids = np.asarray(triple_ids)
+        self.starts = pair_index.offsets[self.triple_ids]
+        self.counts = pair_index.counts()[self.triple_ids]
+        self.rows = pair_index.rows
+        self.num_samples = int(self.counts.sum())
+        self.batch_size = batch_size
+        self.mode = mode
+        self.drop_last = drop_last
+
+    def _order(self, rng):
+        if self.mode == 'balanced':
+            groups = rng.randint(len(self.counts), size=self.num_samples)
+            within = (rng.rand(self.num_samples) * self.counts[groups]).astype(np.int64)
+            return self.rows[self.starts[groups] + within]
+        # Spread every triple evenly over the epoch: its k-th row (in a
+        # random order) gets a key in [k / count, (k + 1) / count)
+        groups = np.repeat(np.arange(len(self.counts)), self.counts)
+        first = np.repeat(np.cumsum(self.counts) - self.counts, self.counts)
+        rank = np.arange(self.num_samples) - first
+        rows = self.rows[self.starts[groups] + rank]
+        shuffled = np.lexsort((rng.rand(self.num_samples), groups))
+        keys = (rank + rng.rand(self.num_samples)) / self.counts[groups]
+        return rows[shuffled][np.argsort(keys, kind='stable')]
+
+    def __iter__(self):
+        order = self._order(self._rng())
+        batches = [order[i:i + self.batch_size]
+                   for i in range(0, len(order), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        yield from _skip_samples(batches, self._take_position())
+
+    def __len__(self):
+        num_samples = self.num_samples - self.position
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return (num_samples + self.batch_size - 1) // self.batch_size
+
+
 class ClevrDataLoader(DataLoader):
     def __init__(self, **kwargs):
-        if 'question_h5' not in kwargs:
-            raise ValueError('Must give question_h5')
-        if 'feature_h5' not in kwargs:
-            raise ValueError('Must give feature_h5')
+        # A ClevrDataset that is already loaded can be given instead of the
+        # files, to share it with another loader
+        shared_dataset = kwargs.pop('dataset', None)
+        if shared_dataset is None:
+            if 'question_h5' not in kwargs:
+                raise ValueError('Must give question_h5')
+            if 'feature_h5' not in kwargs:
+                raise ValueError('Must give feature_h5')
         if 'vocab' not in kwargs:
             raise ValueError('Must give vocab')
 
-        feature_h5_path = kwargs.pop('feature_h5')
-        print('Reading features from ', feature_h5_path)
-
+        feature_h5_path = kwargs.pop('feature_h5', None)
+        image_h5_path = kwargs.pop('image_h5', None)
         self.image_h5 = None
-        if 'image_h5' in kwargs:
-            image_h5_path = kwargs.pop('image_h5')
-            print('Reading images from ', image_h5_path)
-            self.image_h5 = h5py.File(image_h5_path, 'r')
+        if shared_dataset is None:
+            print('Reading features from ', feature_h5_path)
+            if image_h5_path is not None:
+                print('Reading images from ', image_h5_path)
+                self.image_h5 = h5py.File(image_h5_path, 'r')
 
         vocab = kwargs.pop('vocab')
         mode = kwargs.pop('mode', 'prefix')
         load_features = kwargs.pop('load_features', False)
+        batch_fetch = kwargs.pop('batch_fetch', False)
+        decoded_cache = kwargs.pop('decoded_cache', False)
+        build_program_json = kwargs.pop('build_program_json', False)
+        decode_threads = kwargs.pop('decode_threads', 0)
+        uint8_images = kwargs.pop('uint8_images', False)
+        image_dtype = np.uint8 if uint8_images else np.float32
+        fixed_shape = kwargs.pop('fixed_shape', False)
+        collate_buffers = kwargs.pop('collate_buffers', 2)
+        resumable = kwargs.pop('resumable', False)
+        seed = kwargs.pop('seed', None)
+        block_shuffle = kwargs.pop('block_shuffle', False)
+        shuffle_block_size = kwargs.pop('shuffle_block_size', None)
+        shuffle_window_blocks = kwargs.pop('shuffle_window_blocks', 16)
+        bucket_by_length = kwargs.pop('bucket_by_length', False)
+        bucket_batches = kwargs.pop('bucket_batches', 100)
+        pair_sampling = kwargs.pop('pair_sampling', None)
+        pairs = kwargs.pop('pairs', None)
+        if pairs is not None and pair_sampling is None:
+            pair_sampling = 'stratified'
+        self.trim_questions = kwargs.pop('trim_questions', False)
+        self.device = kwargs.pop('device', None)
         percent_of_data = kwargs.pop('percent_of_data', 1.)
         question_families = kwargs.pop('question_families', None)
         max_samples = kwargs.pop('max_samples', None)
-        question_h5_path = kwargs.pop('question_h5')
+        question_h5_path = kwargs.pop('question_h5', None)
         image_idx_start_from = kwargs.pop('image_idx_start_from', None)
-        print('Reading questions from ', question_h5_path)
-        with h5py.File(question_h5_path, 'r') as question_h5:
-            self.dataset = ClevrDataset(question_h5, feature_h5_path, vocab, mode,
-                                        image_h5=self.image_h5,
-                                        load_features=load_features,
-                                        max_samples=max_samples,
-                                        question_families=question_families,
-                                        image_idx_start_from=image_idx_start_from,
-                                        percent_of_data=percent_of_data)
-        kwargs['collate_fn'] = clevr_collate
+        source_weights = kwargs.pop('source_weights', None)
+        # Each of these picks the sampling order, so only one can be used
+        orders = [name for name, value in [('pair_sampling', pair_sampling is not None),
+                                           ('bucket_by_length', bucket_by_length),
+                                           ('source_weights', source_weights is not None),
+                                           ('block_shuffle', block_shuffle)] if value]
+        if len(orders) > 1:
+            raise ValueError('%s can not be combined' % ' and '.join(orders))
+        if shared_dataset is not None:
+            self.dataset = shared_dataset
+        else:
+            # Lists of question and feature files are read as one
+            # ClevrUnionDataset
+            question_h5_paths = question_h5_path
+            feature_h5_paths = feature_h5_path
+            if not isinstance(question_h5_path, (list, tuple)):
+                question_h5_paths = [question_h5_path]
+                feature_h5_paths = [feature_h5_path]
+            if len(question_h5_paths) != len(feature_h5_paths):
+                raise ValueError('Must give as many feature_h5 as question_h5')
+            # max_samples applies to the union, taking samples from the
+            # sources in order, whereas percent_of_data and
+            # image_idx_start_from apply to every source
+            datasets = []
+            remaining = max_samples
+            for question_h5_path, feature_h5_path in zip(question_h5_paths, feature_h5_paths):
+                if remaining is not None and remaining <= 0:
+                    print('Skipping ', question_h5_path, ', max_samples is reached')
+                    continue
+                print('Reading questions from ', question_h5_path)
+                with h5py.File(question_h5_path, 'r') as question_h5:
+                    datasets.append(ClevrDataset(question_h5, feature_h5_path, vocab, mode,
+                                                 image_h5=self.image_h5,
+                                                 load_features=load_features,
+                                                 max_samples=remaining,
+                                                 question_families=question_families,
+                                                 image_idx_start_from=image_idx_start_from,
+                                                 percent_of_data=percent_of_data,
+                                                 decoded_cache=decoded_cache,
+                                                 build_program_json=build_program_json,
+                                                 decode_threads=decode_threads,
+                                                 uint8_images=uint8_images))
+                if remaining is not None:
+                    remaining -= len(datasets[-1])
+            if source_weights is not None and len(datasets) < len(question_h5_paths):
+                raise ValueError('max_samples leaves sources without samples, '
+                                 'which source_weights can not weight')
+            self.dataset = datasets[0]
+            if len(datasets) > 1:
+                if self.image_h5 is not None:
+                    raise ValueError('image_h5 is not supported with several sources')
+                self.dataset = ClevrUnionDataset(datasets)
+        kwargs['collate_fn'] = partial(clevr_collate, decode_threads=decode_threads,
+                                       image_dtype=image_dtype)
+        if fixed_shape:
+            if kwargs.get('num_workers', 0) > 0:
+                # Batches collated in workers are handed over through shared
+                # memory, so their buffers can not be reused
+                collate_buffers = 0
+            kwargs['collate_fn'] = FixedShapeCollate(max(decode_threads, 1), collate_buffers,
+                                                     image_dtype)
+        self.resumable_sampler = None
+        self.index_batch_sampler = None
+        self.pair_index = None
+        if pair_sampling is not None:
+            # (lhs, rel, rhs) triples are given as tokens, None matches any
+            self.pair_index = PairIndex(self.dataset.all_questions[:len(self.dataset)])
+            triple_ids = None
+            if pairs is not None:
+                token_to_idx = vocab['question_token_to_idx']
+                triple_ids = self.pair_index.select(
+                    [[None if token is None else token_to_idx[token] for token in pair]
+                     for pair in pairs])
+                if len(triple_ids) == 0:
+                    raise ValueError('No question matches the given pairs')
+            kwargs.pop('shuffle', None)
+            self.index_batch_sampler = PairBatchSampler(self.pair_index,
+                                                        kwargs.pop('batch_size', 1),
+                                                        triple_ids, pair_sampling,
+                                                        kwargs.pop('drop_last', False),
+                                                        seed)
+            self.resumable_sampler = self.index_batch_sampler
+        elif bucket_by_length:
+            shuffle = kwargs.pop('shuffle', False)
+            self.index_batch_sampler = LengthBucketBatchSampler(self.dataset.question_lengths(),
+                                                           kwargs.pop('batch_size', 1),
+                                                           bucket_batches, shuffle,
+                                                           kwargs.pop('drop_last', False),
+                                                           seed)
+            if shuffle or resumable:
+                # The bucketed order is resumable in the same way
+                self.resumable_sampler = self.index_batch_sampler
+        elif source_weights is not None:
+            if not isinstance(self.dataset, ClevrUnionDataset):
+                raise ValueError('source_weights needs several sources')
+            kwargs.pop('shuffle', None)
+            self.resumable_sampler = SourceWeightedSampler(self.dataset, source_weights,
+                                                           seed=seed)
+            kwargs['sampler'] = self.resumable_sampler
+        elif block_shuffle and kwargs.pop('shuffle', False):
+            if shuffle_block_size is None:
+                # Align the blocks with the h5 chunks of the features, or
+                # with the batches when they are stored contiguously
+                with h5py.File(self.dataset.feature_h5_path, 'r') as feature_h5:
+                    chunks = feature_h5['features'].chunks
+                shuffle_block_size = (chunks[0] if chunks is not None
+                                      else kwargs.get('batch_size', 1))
+            self.resumable_sampler = BlockShuffleSampler(self.dataset, shuffle_block_size,
+                                                         shuffle_window_blocks, seed)
+            kwargs['sampler'] = self.resumable_sampler
+            # The order only saves reads when a batch is read with one
+            # _read_rows call
+            batch_fetch = True
+        elif resumable:
+            self.resumable_sampler = ResumableSampler(self.dataset, seed,
+                                                      kwargs.pop('shuffle', False))
+            kwargs['sampler'] = self.resumable_sampler
+        if self.device is not None:
+            # Batches are gathered directly from tensors on the device,
+            # see _iter_device
+            if not isinstance(self.dataset, ClevrDataset):
+                raise ValueError('device is only supported with a single source')
+            print('Loading dataset to ', self.device)
+            self.dataset.load_to_device(self.device)
+            self.shuffle = kwargs.pop('shuffle', False)
+            kwargs['num_workers'] = 0
+        elif batch_fetch:
+            # The sampler yields lists of indices and the dataset returns
+            # ready batches, so automatic batching and collation are disabled
+            sampler = kwargs.pop('sampler', None)
+            if self.index_batch_sampler is not None:
+                sampler = self.index_batch_sampler
+            else:
+                if sampler is None:
+                    if kwargs.pop('shuffle', False):
+                        sampler = RandomSampler(self.dataset)
+                    else:
+                        sampler = SequentialSampler(self.dataset)
+                sampler = BatchSampler(sampler,
+                                       kwargs.pop('batch_size', 1),
+                                       kwargs.pop('drop_last', False))
+            kwargs['sampler'] = sampler
+            kwargs['batch_size'] = None
+            kwargs['collate_fn'] = clevr_batch_collate
+        elif self.index_batch_sampler is not None:
+            kwargs['batch_sampler'] = self.index_batch_sampler
+        if kwargs.get('num_workers', 0) == 0:
+            kwargs.pop('persistent_workers', None)
+        else:
+            # A no-op for tensors already shared, e.g. by another loader
+            self.dataset.share_memory()
         super(ClevrDataLoader, self).__init__(self.dataset, **kwargs)
 
+    def __iter__(self):
+        if self.device is not None:
+            batches = self._iter_device()
+        else:
+            batches = super(ClevrDataLoader, self).__iter__()
+        if self.trim_questions:
+            batches = map(partial(trim_question_padding,
+                                  null=self.dataset.vocab['question_token_to_idx']['<NULL>']),
+                          batches)
+        return batches
+
+    def __len__(self):
+        if self.index_batch_sampler is not None:
+            return len(self.index_batch_sampler)
+        if self.device is not None:
+            num_samples = len(self.dataset)
+            if self.drop_last:
+                return num_samples // self.batch_size
+            return (num_samples + self.batch_size - 1) // self.batch_size
+        return super(ClevrDataLoader, self).__len__()
+
+    def _iter_device(self):
+        data = self.dataset.device_data
+        num_samples = len(self.dataset)
+        if self.index_batch_sampler is not None:
+            batches = (torch.LongTensor(indices).to(self.device)
+                       for indices in self.index_batch_sampler)
+        else:
+            if self.resumable_sampler is not None:
+                order = torch.LongTensor(list(self.resumable_sampler)).to(self.device)
+            elif self.shuffle:
+                order = torch.randperm(num_samples, device=self.device)
+            else:
+                order = torch.arange(num_samples, device=self.device)
+            batches = order.split(self.batch_size)
+            if self.drop_last and order.size(0) % self.batch_size:
+                batches = batches[:-1]
+        for indices in batches:
+            batch_size = indices.size(0)
+
+            question = data['questions'][indices]
+            if data['types'] is not None:
+                question = [question, data['types'][indices]]
+            answer = (None,) * batch_size
+            if data['answers'] is not None:
+                answer = data['answers'][indices]
+            program_seq = (None,) * batch_size
+            if data['programs'] is not None:
+                program_seq = data['programs'][indices]
+            feats = data['feats'][data['image_positions'][indices]]
+            if not self.dataset.uint8_images:
+                feats = normalize_images(feats)
+
+            program_json = (None,) * batch_size
+            if data['programs'] is not None and self.dataset.build_program_json:
+                program_json = tuple(self.dataset.program_json(seq)
+                                     for seq in program_seq.cpu())
+
+            yield [question, (None,) * batch_size, feats, answer,
+                   program_seq, program_json]
+
     def close(self):
         if self.image_h5 is not None:
             self.image_h5.close()
@@ -191,7 +1323,164 @@ class ClevrDataLoader(DataLoader):
         self.close()
 
 
-def clevr_collate(batch):
+class ShardedClevrDataLoader(DataLoader):
+    """
+    Loader over the shard files matching the glob pattern `shards`, see
+    ShardedClevrDataset. Besides shards, decode_threads, uint8_images,
+    shuffle, shuffle_buffer and seed, only the options of DataLoader itself
+    are accepted.
+    """
+
+    def __init__(self, **kwargs):
+        if 'shards' not in kwargs:
+            raise ValueError('Must give shards')
+        shards = kwargs.pop('shards')
+        print('Reading shards from ', shards)
+        decode_threads = kwargs.pop('decode_threads', 0)
+        uint8_images = kwargs.pop('uint8_images', False)
+        self.dataset = ShardedClevrDataset(glob.glob(shards),
+                                           shuffle=kwargs.pop('shuffle', False),
+                                           shuffle_buffer=kwargs.pop('shuffle_buffer', 10000),
+                                           seed=kwargs.pop('seed', None),
+                                           decode_threads=decode_threads,
+                                           uint8_images=uint8_images)
+        self.resumable_sampler = None
+        kwargs['collate_fn'] = partial(clevr_collate, decode_threads=decode_threads,
+                                       image_dtype=np.uint8 if uint8_images else np.float32)
+        # Workers would keep the copy of the dataset, and so the epoch, that
+        # they were started with, see ShardedClevrDataset.set_epoch
+        kwargs.pop('persistent_workers', None)
+        super(ShardedClevrDataLoader, self).__init__(self.dataset, **kwargs)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PrefetchLoader(object):
+    """
+    Wraps a loader and keeps up to `num_prefetch` batches in flight, moving
+    them to `device` from a background thread while the current step runs.
+    On CUDA, tensors are pinned (unless the loader already did it) and copied
+    asynchronously on a side stream that the consuming stream waits on.
+    """
+
+    _END = object()
+
+    def __init__(self, loader, device, num_prefetch=2):
+        self.loader = loader
+        self.device = device
+        self.num_prefetch = num_prefetch
+        self.dataset = loader.dataset
+        # The batches queued here, the one being transferred and the one in
+        # use must all have their own collate buffers: on the CPU, .to()
+        # returns them as they are
+        collate_fn = getattr(loader, 'collate_fn', None)
+        if isinstance(collate_fn, FixedShapeCollate) and collate_fn.num_buffers > 0:
+            collate_fn.num_buffers = max(collate_fn.num_buffers, num_prefetch + 2)
+        self.resumable_sampler = getattr(loader, 'resumable_sampler', None)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _transfer(self, data):
+        if torch.is_tensor(data):
+            if self.device.type == 'cuda' and not data.is_cuda and not data.is_pinned():
+                data = data.pin_memory()
+            return data.to(self.device, non_blocking=True)
+        if isinstance(data, list):
+            return [self._transfer(x) for x in data]
+        return data
+
+    def _record_stream(self, data, stream):
+        if torch.is_tensor(data):
+            data.record_stream(stream)
+        elif isinstance(data, list):
+            for x in data:
+                self._record_stream(x, stream)
+
+    def _produce(self, batches, stop):
+        stream = None
+        if self.device.type == 'cuda':
+            stream = torch.cuda.Stream(self.device)
+        try:
+            for batch in self.loader:
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = self._transfer(batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = self._transfer(batch)
+                if not self._put(batches, stop, (batch, event)):
+                    return
+        except Exception as e:
+            self._put(batches, stop, e)
+        self._put(batches, stop, self._END)
+
+    @staticmethod
+    def _put(batches, stop, item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is self._END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    self._record_stream(batch, current_stream)
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
+
+
+def trim_question_padding(batch, null):
+    """
+    Drops the trailing question columns that are <NULL> in the whole batch.
+    The encoders only look up to the last non-<NULL> token of every
+    question, so this shortens their RNN without changing the result.
+    """
+    question = batch[0]
+    tokens = question[0] if isinstance(question, list) else question
+    length = max(int((tokens != null).sum(1).max()), 1)
+    if length < tokens.size(1):
+        tokens = tokens[:, :length].contiguous()
+        if isinstance(question, list):
+            batch[0] = [tokens] + question[1:]
+        else:
+            batch[0] = tokens
+    return batch
+
+
+def clevr_batch_collate(batch):
+    # Batches fetched with ClevrDataset._get_batch are already collated
+    return batch
+
+
+def clevr_collate(batch, decode_threads=1, image_dtype=np.float32):
     transposed = list(zip(*batch))
     question_batch = default_collate(transposed[0])
 
@@ -200,7 +1489,9 @@ def clevr_collate(batch):
         image_batch = default_collate(image_batch)
 
     feat_batch = transposed[2]
-    if all(f is not None for f in feat_batch):
+    if isinstance(feat_batch[0], np.ndarray) and feat_batch[0].ndim == 1:
+        feat_batch = decode_png_batch(feat_batch, decode_threads, image_dtype)
+    elif all(f is not None for f in feat_batch):
         feat_batch = default_collate(feat_batch)
 
     answer_batch = transposed[3]
@@ -215,3 +1506,89 @@ def clevr_collate(batch):
 
     return [question_batch, image_batch, feat_batch, answer_batch,
             program_seq_batch, program_struct_batch]
+
+
+class FixedShapeCollate(object):
+    """
+    A faster replacement of clevr_collate for datasets where every question,
+    program and feature has the same shape (e.g. SQOOP). Each field is filled
+    in place into output tensors allocated once, and only the first sample is
+    checked for missing fields.
+
+    With num_buffers > 0 a ring of that many output sets is reused across
+    batches, so a batch is overwritten num_buffers batches later. This is
+    only safe when collation runs in the main process and the consumer
+    holds fewer than num_buffers batches at a time; PrefetchLoader enlarges
+    the ring to cover the batches it queues. Every thread has its own
+    rings, one per batch size, so that e.g. two PrefetchLoader threads never
+    share buffers.
+    """
+
+    def __init__(self, decode_threads=1, num_buffers=2, image_dtype=np.float32):
+        self.decode_threads = decode_threads
+        self.num_buffers = num_buffers
+        self.image_dtype = image_dtype
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _allocate(self, batch):
+        batch_size = len(batch)
+        buffers = []
+        for field in batch[0]:
+            if isinstance(field, list):
+                buffers.append([x.new_empty((batch_size,) + x.shape) for x in field])
+            elif isinstance(field, np.ndarray):
+                # An undecoded PNG blob, decode_png_batch allocates the output
+                buffers.append(None)
+            elif field is not None:
+                buffers.append(field.new_empty((batch_size,) + field.shape))
+            else:
+                buffers.append(None)
+        if torch.utils.data.get_worker_info() is not None:
+            for buffer in buffers:
+                for tensor in (buffer if isinstance(buffer, list) else [buffer]):
+                    if tensor is not None:
+                        tensor.share_memory_()
+        return buffers
+
+    def _get_buffers(self, batch):
+        if self.num_buffers == 0:
+            return self._allocate(batch)
+        if not hasattr(self._local, 'rings'):
+            self._local.rings = {}
+        # Every batch size, e.g. that of a short last batch, has its own ring
+        # and counter
+        ring = self._local.rings.setdefault(len(batch), {'buffers': [], 'num_batches': 0})
+        index = ring['num_batches'] % self.num_buffers
+        ring['num_batches'] += 1
+        while index >= len(ring['buffers']):
+            ring['buffers'].append(self._allocate(batch))
+        return ring['buffers'][index]
+
+    def __call__(self, batch):
+        buffers = self._get_buffers(batch)
+        output = []
+        for i, buffer in enumerate(buffers):
+            first = batch[0][i]
+            if isinstance(first, list):
+                for j, out in enumerate(buffer):
+                    torch.stack([sample[i][j] for sample in batch], out=out)
+                output.append(buffer)
+            elif isinstance(first, np.ndarray):
+                buffer = decode_png_batch([sample[i] for sample in batch],
+                                          self.decode_threads, self.image_dtype, out=buffer)
+                buffers[i] = buffer
+                output.append(buffer)
+            elif buffer is not None:
+                output.append(torch.stack([sample[i] for sample in batch], out=buffer))
+            else:
+                output.append(tuple(sample[i] for sample in batch))
+        return output